@@ -0,0 +1,8 @@
+""" Throughput benchmarks for the converter, run on synthetic mARkdown documents.
+
+    python -m benchmarks --sizes 10KB,1MB,10MB --output results.json
+    python -m benchmarks --sizes 100MB,500MB --mix riwayat=10,verse=0 --baseline old.json
+
+Parsing, conversion and serialization are timed separately for each size and
+written to a JSON file, so that runs of different versions can be compared.
+The time taken to import oitei is measured by python -m benchmarks.imports. """
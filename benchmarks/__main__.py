@@ -0,0 +1,137 @@
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import oimdp
+import oitei
+from lxml import etree
+
+import benchmarks
+from benchmarks.generate import DEFAULT_MIX, generate, parse_mix, parse_size
+
+PHASES = ["parse", "init", "convert", "tostring"]
+DEFAULT_SIZES = "10KB,100KB,1MB,10MB"
+
+
+def versions() -> Dict[str, str]:
+    try:
+        from importlib.metadata import version
+        oimdp_version = version("oimdp")
+    except Exception:
+        oimdp_version = "unknown"
+    return {
+        "oitei": oitei.__version__,
+        "oimdp": oimdp_version,
+        "lxml": etree.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def _timed(fn):
+    gc.collect()
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def bench_text(text: str, repeat=1, pretty=True) -> Dict:
+    """ Time each phase on text, keeping the best of repeat runs.
+        init is the Converter set up from the parsed document, which indexes page numbers. """
+    runs = {phase: [] for phase in PHASES}
+    for _ in range(repeat):
+        md, t = _timed(lambda: oimdp.parse(text))
+        runs["parse"].append(t)
+        structures = len(md.content)
+        converter, t = _timed(lambda: oitei.Converter(None, None, document=md))
+        del md
+        runs["init"].append(t)
+        _, t = _timed(converter.convert)
+        runs["convert"].append(t)
+        elements = sum(1 for _ in converter.doc.iter())
+        tei, t = _timed(lambda: converter.tostring(pretty))
+        runs["tostring"].append(t)
+        output_bytes = len(tei.encode("utf-8"))
+        del converter, tei
+
+    input_bytes = len(text.encode("utf-8"))
+    best = {phase: min(times) for phase, times in runs.items()}
+    total = sum(best.values())
+    return {
+        "bytes": input_bytes,
+        "structures": structures,
+        "elements": elements,
+        "output_bytes": output_bytes,
+        "seconds": best,
+        "runs": runs,
+        "total": total,
+        "mb_per_s": input_bytes / (1 << 20) / total if total else None,
+    }
+
+
+def run(sizes: List[str], repeat=1, seed=0, mix=None, pretty=True) -> Dict:
+    results = []
+    for size in sizes:
+        text = generate(size, seed, mix)
+        result = {"size": size, "target_bytes": parse_size(size)}
+        result.update(bench_text(text, repeat, pretty))
+        del text
+        results.append(result)
+        print(format_result(result), file=sys.stderr)
+    return {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "versions": versions(),
+        "settings": {"seed": seed, "mix": mix or DEFAULT_MIX, "repeat": repeat, "pretty": pretty},
+        "results": results,
+    }
+
+
+def format_result(result: Dict) -> str:
+    phases = "  ".join(f"{phase} {result['seconds'][phase]:8.3f}s" for phase in PHASES)
+    return f"{result['size']:>8}  {phases}  {result['mb_per_s']:7.2f} MB/s"
+
+
+def compare(report: Dict, baseline: Dict) -> List[str]:
+    """ Speed-up of each phase over a previous report, for the sizes both have. """
+    previous = {r["size"]: r for r in baseline["results"]}
+    lines = [f"Compared to oitei {baseline['versions']['oitei']} ({baseline['date']}):"]
+    for result in report["results"]:
+        old = previous.get(result["size"])
+        if old is None:
+            continue
+        ratios = "  ".join(
+            f"{phase} x{old['seconds'][phase] / result['seconds'][phase]:.2f}"
+            for phase in PHASES if result["seconds"][phase]
+        )
+        lines.append(f"{result['size']:>8}  {ratios}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=benchmarks.__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"comma separated document sizes (default: {DEFAULT_SIZES})")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per size, the best one is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mix", default="", help="structure weights, e.g. riwayat=5,verse=0")
+    parser.add_argument("--compact", action="store_true", help="serialize without indentation")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    args = parser.parse_args(argv)
+
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+    report = run(sizes, args.repeat, args.seed, parse_mix(args.mix), not args.compact)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print("\n".join(compare(report, json.load(f))), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
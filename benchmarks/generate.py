@@ -0,0 +1,166 @@
+""" Synthetic OpenITI mARkdown documents of a given size and mix of structures. """
+import re
+import random
+from typing import Dict, Iterator, Optional
+
+MAGIC = "######OpenITI#"
+
+WORDS = [
+    "حدثنا", "أخبرنا", "قال", "عن", "بن", "أبو", "محمد", "أحمد", "علي", "الحسن",
+    "عبد", "الله", "الرحمن", "في", "من", "إلى", "كان", "الناس", "العلم", "الكتاب",
+    "البصرة", "الكوفة", "بغداد", "مكة", "المدينة", "الشعر", "الفقه", "الحديث", "النبي", "صلى",
+    "عليه", "وسلم", "رضي", "عنه", "سنة", "مات", "ولد", "وكان", "ثقة", "حافظا",
+]
+
+# Relative frequency of each kind of block.
+DEFAULT_MIX = {
+    "section": 2,
+    "paragraph": 10,
+    "riwayat": 4,
+    "verse": 3,
+    "bio": 2,
+    "event": 1,
+    "page": 3,
+}
+
+UNITS = {"B": 1, "KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30}
+
+
+def parse_size(size) -> int:
+    """ Number of bytes in a size such as 10KB or 500MB. """
+    if isinstance(size, int):
+        return size
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B)?\s*", size.upper())
+    if not m:
+        raise ValueError(f"Not a size: {size}")
+    return int(float(m.group(1)) * UNITS[m.group(2) or "B"])
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    """ Structure mix from a string such as riwayat=5,verse=0 (unlisted kinds keep their default). """
+    weights = dict(DEFAULT_MIX)
+    for item in filter(None, mix.split(",")):
+        kind, _, weight = item.partition("=")
+        if kind not in DEFAULT_MIX:
+            raise ValueError(f"Unknown structure: {kind}")
+        weights[kind] = int(weight)
+    return weights
+
+
+class Generator:
+    """ Produces the lines of a mARkdown document, block by block.
+        The output only depends on the seed and the settings. """
+
+    def __init__(self, seed=0, mix: Optional[Dict[str, int]] = None, max_depth=4,
+                 entity_rate=0.05, page_rate=0.1):
+        self.random = random.Random(seed)
+        mix = mix or DEFAULT_MIX
+        self.kinds = [k for k in mix if mix[k] > 0]
+        self.weights = [mix[k] for k in self.kinds]
+        if not self.kinds:
+            raise ValueError("The structure mix is empty")
+        self.max_depth = max_depth
+        self.entity_rate = entity_rate
+        self.page_rate = page_rate
+        self.depth = 0
+        self.volume = 1
+        self.page = 0
+
+    def header(self) -> str:
+        return "\n".join([
+            MAGIC,
+            "",
+            "#META# 000.SortField\t:: Synthetic",
+            "#META# 010.AuthorNAME\t:: " + self.words(4),
+            "#META# 020.BookTITLE\t:: " + self.words(3),
+            "",
+            "#META#Header#End#",
+            "",
+        ])
+
+    def words(self, n: int) -> str:
+        return " ".join(self.random.choice(WORDS) for _ in range(n))
+
+    def pagenumber(self) -> str:
+        self.page += 1
+        if self.page > 500:
+            self.volume += 1
+            self.page = 1
+        return f"PageV{self.volume:02d}P{self.page:03d}"
+
+    def text(self, n: int) -> str:
+        """ Running text with named entities, dates and the odd page break. """
+        tokens = []
+        while len(tokens) < n:
+            r = self.random.random()
+            if r < self.entity_rate:
+                tag = self.random.choice(["@PER", "@TOP", "@SRC", "@SOC"])
+                tokens.append(f"{tag}0{self.random.randint(1, 3)} {self.words(2)}")
+            elif r < self.entity_rate * 1.5:
+                tokens.append(f"@YD{self.random.randint(100, 999)}")
+            tokens.append(self.random.choice(WORDS))
+        if self.random.random() < self.page_rate:
+            tokens.insert(self.random.randrange(len(tokens)), self.pagenumber())
+        return " ".join(tokens)
+
+    def lines(self, first: str, n: int) -> Iterator[str]:
+        yield first + self.text(self.random.randint(5, 15))
+        for _ in range(n):
+            yield "~~" + self.text(self.random.randint(8, 15))
+
+    def block(self) -> Iterator[str]:
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        if kind == "section":
+            # Go down at most one level at a time, up any number of levels.
+            self.depth = self.random.randint(1, min(self.depth + 1, self.max_depth))
+            yield "### " + "|" * self.depth + " " + self.words(self.random.randint(2, 6))
+        elif kind == "paragraph":
+            yield from self.lines("# ", self.random.randint(0, 4))
+        elif kind == "riwayat":
+            isnad = self.text(self.random.randint(6, 12))
+            matn = self.text(self.random.randint(8, 20))
+            hukm = " @HUKM@ " + self.words(3) if self.random.random() < 0.2 else ""
+            yield f"# $RWY$ {isnad} @MATN@ {matn}{hukm}"
+            for _ in range(self.random.randint(0, 2)):
+                yield "~~" + self.text(self.random.randint(8, 15))
+        elif kind == "verse":
+            for _ in range(self.random.randint(1, 4)):
+                yield f"# {self.words(self.random.randint(3, 5))} %~% {self.words(self.random.randint(3, 5))}"
+        elif kind == "bio":
+            marker = self.random.choice(["### $ ", "### $$ ", "### $BIO_MAN$ "])
+            yield from self.lines(marker, self.random.randint(1, 4))
+        elif kind == "event":
+            yield from self.lines("### @ ", self.random.randint(0, 3))
+        elif kind == "page":
+            yield self.pagenumber()
+
+    def __iter__(self) -> Iterator[str]:
+        yield self.header()
+        yield self.pagenumber()
+        while True:
+            yield from self.block()
+
+
+def iter_lines(size, seed=0, mix=None, **kwargs) -> Iterator[str]:
+    """ Lines of a document of at least size bytes (UTF-8, newlines included). """
+    target = parse_size(size)
+    written = 0
+    for line in Generator(seed, mix, **kwargs):
+        yield line
+        written += len(line.encode("utf-8")) + 1
+        if written >= target:
+            return
+
+
+def generate(size, seed=0, mix=None, **kwargs) -> str:
+    return "\n".join(iter_lines(size, seed, mix, **kwargs)) + "\n"
+
+
+def write(path: str, size, seed=0, mix=None, **kwargs) -> int:
+    """ Write a document to path without holding it in memory. Returns the number of bytes written. """
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for line in iter_lines(size, seed, mix, **kwargs):
+            f.write(line + "\n")
+            written += len(line.encode("utf-8")) + 1
+    return written
@@ -0,0 +1,129 @@
+""" Cold start benchmark: the time taken to import oitei and oitei.corpus in a new interpreter.
+
+    python -m benchmarks.imports --repeat 10 --output imports.json
+    python -m benchmarks.imports --baseline imports.json --max-ms 100
+
+Also checks that importing does not load the modules that oitei only imports when needed,
+nor set up logging. Exits with status 1 if it does, or if an import takes longer than --max-ms. """
+import os
+import sys
+import json
+import argparse
+import subprocess
+from datetime import datetime, timezone
+from typing import Dict, List
+
+from benchmarks.__main__ import versions
+
+MODULES = ["oitei", "oitei.corpus"]
+# Slow to import, and only imported by the code that needs them.
+# (Not shutil: tempfile, which oitei.corpus needs to set up its log, imports it.)
+DEFERRED = ["requests", "zipfile", "multiprocessing", "concurrent.futures.process",
+            "openiti.helper.funcs", "pickle"]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run with -S: .pth files of site-packages can import modules at startup, which would hide
+# those imported by oitei. The paths of this interpreter are given explicitly instead.
+_PROBE = """
+import sys, time
+sys.path[:] = {path!r}
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+import json, logging
+print(json.dumps({{
+    "seconds": seconds,
+    "modules": sorted(set(sys.modules) - before),
+    "log_handlers": len(logging.getLogger().handlers),
+}}))
+"""
+
+
+def probe(module: str) -> Dict:
+    """ Import module in a new interpreter. Returns the time it took, the modules it loaded
+        (besides those loaded by the interpreter itself) and the number of root log handlers. """
+    path = [ROOT] + [p for p in sys.path if p and os.path.abspath(p) != ROOT]
+    out = subprocess.run([sys.executable, "-S", "-c", _PROBE.format(module=module, path=path)], cwd=ROOT,
+                         check=True, capture_output=True, text=True).stdout
+    return json.loads(out)
+
+
+def bench_import(module: str, repeat=5) -> Dict:
+    runs = [probe(module) for _ in range(repeat)]
+    return {
+        "module": module,
+        "seconds": min(run["seconds"] for run in runs),
+        "runs": [run["seconds"] for run in runs],
+        "modules": len(runs[0]["modules"]),
+        "deferred_loaded": [m for m in DEFERRED if m in runs[0]["modules"]],
+        "log_handlers": runs[0]["log_handlers"],
+    }
+
+
+def run(modules: List[str], repeat=5) -> Dict:
+    results = []
+    for module in modules:
+        result = bench_import(module, repeat)
+        results.append(result)
+        print(format_result(result), file=sys.stderr)
+    return {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "versions": versions(),
+        "settings": {"repeat": repeat},
+        "results": results,
+    }
+
+
+def format_result(result: Dict) -> str:
+    deferred = ", ".join(result["deferred_loaded"]) or "none"
+    return f"{result['module']:>14}  {result['seconds'] * 1000:7.1f} ms  {result['modules']:4d} modules  deferred loaded: {deferred}"
+
+
+def problems(report: Dict, max_ms: float = None) -> List[str]:
+    found = []
+    for result in report["results"]:
+        if result["deferred_loaded"]:
+            found.append(f"{result['module']} imports {', '.join(result['deferred_loaded'])}")
+        if result["log_handlers"]:
+            found.append(f"{result['module']} sets up logging on import")
+        if max_ms is not None and result["seconds"] * 1000 > max_ms:
+            found.append(f"{result['module']} takes {result['seconds'] * 1000:.1f} ms to import (max {max_ms} ms)")
+    return found
+
+
+def compare(report: Dict, baseline: Dict) -> List[str]:
+    previous = {r["module"]: r for r in baseline["results"]}
+    lines = [f"Compared to oitei {baseline['versions']['oitei']} ({baseline['date']}):"]
+    for result in report["results"]:
+        old = previous.get(result["module"])
+        if old is not None and result["seconds"]:
+            lines.append(f"{result['module']:>14}  x{old['seconds'] / result['seconds']:.2f}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.imports", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", default=",".join(MODULES), help="comma separated modules to import")
+    parser.add_argument("--repeat", type=int, default=5, help="imports per module, the fastest one is kept")
+    parser.add_argument("--max-ms", type=float, help="longest acceptable import time")
+    parser.add_argument("--output", default="import-results.json")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    args = parser.parse_args(argv)
+
+    modules = [m.strip() for m in args.modules.split(",") if m.strip()]
+    report = run(modules, args.repeat)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print("\n".join(compare(report, json.load(f))), file=sys.stderr)
+    found = problems(report, args.max_ms)
+    if found:
+        print("\n".join(found), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,48 @@
 from .converter import Converter
 from .converter import Metadata
+from .parsecache import ParseCache
+from .resultcache import ResultCache
+from oimdp.structures import Document
 
-def convert(text: str, metadata: Metadata = None):
-    """Convert to TEI from a mARkdown string"""
-    C = Converter(text, metadata)
-    C.convert()
+def convert(text: str, metadata: Metadata = None, profile=False, parse_cache: ParseCache = None, jobs=1,
+            low_memory=False):
+    """Convert to TEI from a mARkdown string.
+    With profile=True, timings and counters are collected in the converter's profile.
+    With a parse_cache, a text that was parsed before is not parsed again.
+    With jobs > 1, a large text is converted by that many processes.
+    With low_memory=True, parsed structures are released as they are converted."""
+    C = Converter(text, metadata, profile, parse_cache=parse_cache, low_memory=low_memory)
+    C.convert(jobs)
 
     return C
 
-# def convert_from_document(doc):
-#     """Convert to TEI from a oimdp-parsed mARkdown object"""
-#     return converter(doc)
+def convert_from_document(document: Document, metadata: Metadata = None, profile=False, jobs=1,
+                          low_memory=False):
+    """Convert to TEI from a oimdp-parsed mARkdown object.
+    With low_memory=True, the content of the document is consumed by the conversion."""
+    C = Converter(None, metadata, profile, document=document, low_memory=low_memory)
+    C.convert(jobs)
+
+    return C
+
+def register_structure(cls, handler=None):
+    """Register handler(converter, content, pos) to convert an oimdp structure class
+    (and its subclasses). Can be used as a decorator."""
+    return Converter.structure_handlers.register(cls, handler)
+
+def register_part(cls, handler=None):
+    """Register handler(converter, part, pos) to convert an oimdp line part class
+    (and its subclasses). Can be used as a decorator."""
+    return Converter.part_handlers.register(cls, handler)
 
 
 __all__ = [
    'convert',
-#    'convert_from_document'
+   'register_structure',
+   'register_part',
+   'convert_from_document',
+   'ParseCache',
+   'ResultCache',
 ]
-__version__ = '1.0.0'
+# Also the version of the package, read by setup.py.
+__version__ = '2.0.0'
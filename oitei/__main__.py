@@ -0,0 +1,25 @@
+import argparse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m oitei", description="OpenITI mARkdown to TEI converter")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    from oitei import serve
+    serve_parser = commands.add_parser("serve", help="convert jobs read from stdin as JSON lines",
+                                       description=serve.__doc__,
+                                       formatter_class=argparse.RawDescriptionHelpFormatter)
+    serve_parser.add_argument("--jobs", type=int, default=1, help="worker processes")
+    serve_parser.add_argument("--in-flight", type=int,
+                              help="most jobs handed out to the workers at once, with --jobs > 1 "
+                                   "(default: twice --jobs)")
+    serve_parser.set_defaults(run=serve.main)
+
+    args = parser.parse_args(argv)
+    if args.command == "serve" and args.in_flight is not None and args.jobs <= 1:
+        serve_parser.error("--in-flight needs --jobs > 1")
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import os
+from typing import BinaryIO, Callable, Union
+
+
+def write_atomic(path: str, data: Union[bytes, Callable[[BinaryIO], None]]) -> int:
+    """ Write data to the file path, and return the number of bytes written.
+        data is bytes, or a function writing to the binary file object it is given.
+        If writing fails, the file at path is left as it was. """
+    import tempfile
+    # Written to a temporary file in the same folder, then renamed into place: readers (other
+    # processes, the next run) see the previous file or the complete new one, never a partial one.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if callable(data):
+                data(f)
+            else:
+                f.write(data)
+            size = f.tell()
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return size
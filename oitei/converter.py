@@ -1,11 +1,188 @@
+import os
 import oimdp
+import logging
+from bisect import bisect_left
+from collections import namedtuple
+from copy import deepcopy
+from contextlib import contextmanager, nullcontext
 from oimdp.structures import *
 from lxml import etree
 from lxml.etree import Element
-from typing import TypedDict
-
-from oitei.tei_template import TEI_TEMPLATE, DECLS
-from oitei.namespaces import TEINS, NS
+from typing import Iterable, Iterator, List, TypedDict
+
+from oitei._atomic import write_atomic
+from oitei.tei_template import TEI_TEMPLATE, DECLS_BYTES
+from oitei.namespaces import TEINS, XINS, NS
+from oitei.registry import HandlerRegistry
+from oitei.profiling import Profile
+from oitei.parsecache import ParseCache
+
+logger = logging.getLogger(__name__)
+
+
+SPACE = "  "
+# <body> is at TEI/text/body: its children are indented at the fourth level.
+BODY_LEVEL = 3
+SEPARATOR = ("\n" + SPACE * BODY_LEVEL).encode("utf-8")
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+XML_DECL = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+
+# Fewest structures per process for a parallel conversion to be worth it.
+MIN_CHUNK = 1000
+RIWAYAT_PARTS = (Isnad, Matn, Hukm)
+EMPTY_TEXT = "oitei-empty-text"
+# A page number, as kept by the page number index of a low-memory conversion.
+PageRef = namedtuple("PageRef", ["volume", "page"])
+# Characters of mARkdown parsed at a time by Converter.from_file().
+CHUNK_SIZE = 1024 * 1024
+# What the worker processes of a parallel conversion need of the converter: set before they
+# are forked, so that they share the parsed document rather than receive it pickled.
+_shared = None
+
+PARALIKE = (f"{TEINS}p", f"{TEINS}ab", f"{TEINS}entryFree", f"{TEINS}lg")
+VIABLE_CHILDREN = (f"{TEINS}lb", f"{TEINS}pb", f"{TEINS}head")
+
+
+def _last_child(el):
+    """ Last child of el, without building the list of all its children. """
+    try:
+        return el[-1]
+    except IndexError:
+        return None
+
+
+def _is_viable(container):
+    """  check that the <div> is either empty or only contains lb, pb, or head """
+    for child in container:
+        if child.tag not in VIABLE_CHILDREN:
+            return False
+    return True
+
+
+def _indent(root, level=0, changes: List = None):
+    """ Pretty print a subtree in place, as if it were located at the given depth.
+        Like etree.indent, whitespace-only text and tails are replaced with indentation.
+        Tails ending with a line break are indented too, despite etree's nonesensical insistence
+        that doing so alters data (any sequence of spaces is one space in XML unless
+        xml:space="preserve" is specified).
+        Both are done in one walk of the tree, without recursion.
+        With a changes list, the text and tails replaced are recorded in it for _unindent(). """
+    indents = []
+
+    def indentation(depth):
+        while len(indents) <= depth:
+            indents.append("\n" + SPACE * len(indents))
+        return indents[depth]
+
+    # (element, depth, is last child, inside xml:space="preserve")
+    stack = [(root, level, False, False)]
+    while stack:
+        el, depth, islast, preserve = stack.pop()
+        preserve = preserve or el.get(XML_SPACE) == "preserve"
+        outer = depth - 1 if islast else depth
+        tail = el.tail
+        if el is not root and (not tail or tail.isspace()):
+            el.tail = indentation(outer)
+            if changes is not None:
+                changes.append((el, "tail", tail))
+        elif not preserve and tail and tail.endswith("\n"):
+            el.tail = tail + SPACE * outer
+            if changes is not None:
+                changes.append((el, "tail", tail))
+        if len(el):
+            text = el.text
+            if not text or text.isspace():
+                el.text = indentation(depth + 1)
+                if changes is not None:
+                    changes.append((el, "text", text))
+            for count, child in enumerate(reversed(el)):
+                stack.append((child, depth + 1, count == 0, preserve))
+
+
+def _unindent(changes: List):
+    """ Put back the text and tails recorded by _indent(). """
+    for el, attr, value in reversed(changes):
+        setattr(el, attr, value)
+
+
+def _read_chunks(path: str, chunk_size=CHUNK_SIZE):
+    """ Read a mARkdown file in chunks of whole lines, of about chunk_size characters.
+        A chunk ends before a section header (### |), unless none comes for four times
+        chunk_size: oimdp parses each line on its own, so that any line is a safe boundary.
+        The metadata lines at the top of the document all go to the first chunk.
+        A leading byte order mark is skipped. """
+    with open(path, "r") as f:
+        first = f.readline()
+        if first.startswith("\ufeff"):
+            first = first[1:]
+        chunk = [first]
+        size = len(first)
+        header = True
+        for line in f:
+            if header and line.strip() and not line.startswith("#META#"):
+                header = False
+            if not header and size >= chunk_size and (line.startswith("### |") or size >= 4 * chunk_size):
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+            chunk.append(line)
+            size += len(line)
+        yield "".join(chunk)
+
+
+def _convert_chunk(task):
+    """ Convert a range of a document's content in a worker process: see Converter._convert_parallel(). """
+    start, end, first, open_seg, profile, shared = task
+    if shared is None:
+        shared = _shared
+    cls, magic_value, content, pagenums, structure_handlers, part_handlers = shared
+    content = content[start:end]
+    document = Document("")
+    document.magic_value = magic_value
+    document.content = content
+    C = cls(None, None, profile, document=document, index=False)
+    C.structure_handlers = structure_handlers
+    C.part_handlers = part_handlers
+    # Page numbers are looked up in the whole document.
+    C._pagenum_index = pagenums[start:end + 1]
+    # Stands for the riwāyāt segment of a previous chunk that still receives text.
+    placeholder = None
+    if open_seg:
+        placeholder = Element(f"{TEINS}seg")
+        C.context_linepart = placeholder
+
+    if first:
+        C._convertFirstPage()
+    for pos, c in enumerate(content):
+        C._convertStructure(c, pos)
+    C._flushText()
+
+    linepart = C.context_linepart
+    if linepart is not None and linepart is not placeholder:
+        path = []
+        while linepart is not C.body:
+            parent = linepart.getparent()
+            if parent is None:
+                path = "detached"
+                break
+            path.insert(0, parent.index(linepart))
+            linepart = parent
+        linepart = path
+    elif linepart is placeholder:
+        linepart = "incoming"
+    top_section = C._stack[C._section_idx[0]] if C._section_idx else None
+    # Serialization does not tell empty text from no text (<head></head> and <head/>).
+    for el in C.body.xpath(".//*[not(*)][text() = '']"):
+        el.set(EMPTY_TEXT, "")
+    return {
+        "body": etree.tostring(C.body),
+        "linepart_text": placeholder.text if placeholder is not None else None,
+        "linepart": linepart,
+        # A top-level section the next header would add its <head> to.
+        "open_section": top_section is not None and _is_viable(top_section),
+        "structures": dict(C.profile.structures) if profile else {},
+        "parts": dict(C.profile.parts) if profile else {},
+    }
 
 
 class Metadata(TypedDict):
@@ -20,84 +197,494 @@ class Metadata(TypedDict):
 class Converter:
     """OpenITI mARkdown to OpenITI TEI converter"""
     # TODO: allow users to provide template or at least URL to schema
-    def __init__(self, text: str, metadata: Metadata):
+    def __init__(self, text: str, metadata: Metadata, profile=False, document: Document = None, parse_cache: ParseCache = None,
+                 index=True, low_memory=False, chunks: Iterable[str] = None):
+        """ Set up the conversion of text, or of document when it was already parsed with oimdp.
+            Parsed documents are looked up in and added to parse_cache, if given.
+            With low_memory=True, the content of the document is consumed by the conversion:
+            each structure is dropped as soon as it is converted (see _content()).
+            chunks is the text split at line boundaries: only the first one is parsed here,
+            the others as the conversion goes, in low-memory mode (see from_file()). """
         self.magic_value = "######OpenITI#"
         self.doc = etree.fromstring(TEI_TEMPLATE)
+        # Timings and counters, see oitei.profiling. None unless profile=True.
+        self.profile = None
+        if profile:
+            self.profile = Profile()
+            self.profile.measure(self.doc)
+            # Only profiled conversions pay for counting.
+            self._convertStructure = self.profile.counting(self._convertStructure, self.profile.structures)
+            self._convertPart = self.profile.counting(self._convertPart, self.profile.parts)
         self.context_linepart = None
         self.metadata = metadata
+        self.low_memory = low_memory
+        # The structure before the one being converted, in low-memory mode.
+        self._lookback = None
+        self._header_converted = False
+        self._converted = False
+        # Open containers from <body> down to the context node, with the positions
+        # in it of the sections (untyped divs) and of all divs.
+        self._stack = []
+        self._section_idx = []
+        self._div_idx = []
+        # Text waiting to be added to the text or tail of an element. See _appendText()
+        self._pending_el = None
+        self._pending_tail = False
+        self._pending_text = []
         
         try:
-            self.context_node = self.doc.find(".//tei:body", NS)
-            self.body = self.context_node
+            self.body = self.doc.find(".//tei:body", NS)
+            self.context_node = self.body
         except Exception:
             raise Exception("Could not initiate TEI document.") 
 
-        try:
-            self.md = oimdp.parse(text)
-        except Exception:
-            raise Exception("Could not parse mARkdown document.") 
+        if document is not None:
+            self.md = document
+        else:
+            try:
+                with self._phase("parse"):
+                    if chunks is not None:
+                        chunks = iter(chunks)
+                        self.md = oimdp.parse(next(chunks, ""))
+                    elif parse_cache is not None:
+                        self.md = parse_cache.parse(text)
+                    else:
+                        self.md = oimdp.parse(text)
+            except Exception:
+                raise Exception("Could not parse mARkdown document.") 
 
         if not str(self.md.magic_value).startswith(self.magic_value):
             raise Exception("Text provided does not appear to be a valid mARkdown document.") 
 
+        # Parallel conversions index the whole document once, see _convert_chunk().
+        self._pagenum_index = []
+        # Position in the document of the first entry of the index.
+        self._index_offset = 0
+        # The content and page number index of the chunks still to be converted.
+        self._next_chunks = None
+        if chunks is not None:
+            self.low_memory = True
+            self._next_chunks = self._parse_chunks(chunks)
+            self.md.content, self._pagenum_index = next(self._next_chunks)
+        elif index:
+            with self._phase("index"):
+                self._pagenum_index = self._index_pagenums()
+
+
+    @classmethod
+    def from_file(cls, path: str, metadata: Metadata = None, profile=False, chunk_size=CHUNK_SIZE):
+        """ Set up the conversion of a mARkdown file that is read and parsed in chunks of about
+            chunk_size characters as the conversion goes, in low-memory mode. With write_to()
+            or write_shards(), neither the text, nor the parsed document, nor the tree of the
+            whole book is ever held in memory, only the chunks up to the next page number.
+            A leading byte order mark is skipped. The header is converted from the metadata
+            of the first chunk. """
+        return cls(None, metadata, profile, chunks=_read_chunks(path, chunk_size))
+
+
+    def _parse_chunks(self, chunks: Iterator[str]):
+        """ Yield the content of the first chunk and of each following one, once parsed,
+            with its page number index. As a page number is looked up in the next ones,
+            chunks are parsed ahead until one holds a page number. """
+        # oimdp expects every text to start with the magic value.
+        magic = f"{self.md.magic_value}\n"
+        pending = [self.md.content]
+        while True:
+            with self._phase("read"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            with self._phase("parse"):
+                document = oimdp.parse(magic + chunk)
+            del chunk
+            if document.simple_metadata:
+                logger.warning("Metadata after the first chunk of the document is left out of the header.")
+            pending.append(document.content)
+            pagenum = self._first_pagenum(document.content)
+            if pagenum is not None:
+                while len(pending) > 1:
+                    content = pending.pop(0)
+                    yield content, self._index_pagenums(content, pagenum)
+        while pending:
+            content = pending.pop(0)
+            yield content, self._index_pagenums(content)
+
+
+    def _phase(self, name: str):
+        """ Context in which the time spent counts towards the given phase, when profiling. """
+        if self.profile is None:
+            return nullcontext()
+        return self.profile.phase(name)
+
+
+    @property
+    def context_node(self):
+        return self._stack[-1]
+
+
+    @context_node.setter
+    def context_node(self, el):
+        """ Move the insertion point, keeping the stack of open containers in sync.
+            The new context is either an open container or a child of one. """
+        parent = el.getparent()
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i] is el:
+                self._truncate(i + 1)
+                return
+            if self._stack[i] is parent:
+                self._truncate(i + 1)
+                self._push(el)
+                return
+        # Not related to the open containers: start over from <body> or the root.
+        self._truncate(0)
+        path = [el]
+        for ancestor in el.iterancestors():
+            if path[-1] is self.body:
+                break
+            path.append(ancestor)
+        for container in reversed(path):
+            self._push(container)
+
+
+    def _push(self, el):
+        if el.tag == f"{TEINS}div":
+            self._div_idx.append(len(self._stack))
+            if el.get("type") is None:
+                self._section_idx.append(len(self._stack))
+        self._stack.append(el)
+
+
+    def _truncate(self, size):
+        del self._stack[size:]
+        while self._section_idx and self._section_idx[-1] >= size:
+            self._section_idx.pop()
+        while self._div_idx and self._div_idx[-1] >= size:
+            self._div_idx.pop()
+
+
+    def _closest_section(self):
+        """ Closest untyped div above the context node, or None. """
+        count = self._section_level() - self._is_section()
+        if count:
+            return self._stack[self._section_idx[count - 1]]
+
+
+    def _closest_div(self):
+        """ Closest div of any type above the context node, or None. """
+        count = len(self._div_idx)
+        if count and self._div_idx[-1] == len(self._stack) - 1:
+            count -= 1
+        if count:
+            return self._stack[self._div_idx[count - 1]]
+
+
+    def _section_level(self):
+        """ Number of untyped divs the context node is in, counting itself. """
+        return len(self._section_idx)
+
+
+    def _section_ancestor(self, level_diff: int):
+        """ The untyped div above the context node, level_diff (< 0) levels up from the
+            innermost one, or None if the context node isn't in any.
+            Like indexing the list of ancestors, level_diff 0 gives the outermost one. """
+        count = self._section_level() - self._is_section()
+        if count:
+            if level_diff == 0:
+                return self._stack[self._section_idx[0]]
+            if count + level_diff < 0:
+                raise IndexError("list index out of range")
+            return self._stack[self._section_idx[count + level_diff]]
+
+
+    def _is_section(self):
+        return bool(self._section_idx) and self._section_idx[-1] == len(self._stack) - 1
 
-    def __str__(self):
 
-        space = "  "
-
-        def text_indent(el, level=0, islast=False):
-            """ Indent text nodes despite etree's nonesensical insistence that doing so alters data.
-                (any sequence of spaces is one space in XML unless xml:space="preserve" is specified) """
-            xml_space = el.get("{http://www.w3.org/XML/1998/namespace}space")
-            if xml_space != "preserve":
-                if str(el.tail).endswith("\n"):
-                    indent = level * space
-                    if islast:
-                        indent = (level-1) * space
-                    el.tail = el.tail + indent
-                tot_children = len(el)
-                if tot_children:
-                    for count, child in enumerate(el):
-                        text_indent(child, level+1, count+1 == tot_children)
-
-        if self.doc is not None:
-            etree.indent(self.doc, space=space)
-            text_indent(self.doc)
-                    
-            tree_str = etree.tostring(self.doc, xml_declaration=False, pretty_print=True, encoding="UTF-8").decode("utf-8")
-            return DECLS + tree_str
-        else:
-            return ""
+    def __str__(self):
+        return self.tostring()
 
     
-    def tostring(self):
-        return self.__str__()
+    def tostring(self, pretty=True):
+        """ Serialize the document. With pretty=False, no indentation is added, which
+            gives a smaller file and skips a pass over the tree. """
+        return self.tobytes(pretty).decode("utf-8")
+
+
+    def tobytes(self, pretty=True) -> bytes:
+        """ Serialize the document to UTF-8, as it is written to files. See tostring(). """
+        if self.doc is None:
+            return b""
+        with self._indented(pretty), self._phase("serialize"):
+            return DECLS_BYTES + etree.tostring(self.doc, xml_declaration=False, pretty_print=pretty, encoding="UTF-8")
+
+
+    def write(self, fileobj, pretty=True):
+        """ Serialize the document to a binary file object, without holding the serialized
+            document in memory. The bytes written are those of tobytes(pretty). """
+        if self.doc is None:
+            return
+        with self._indented(pretty), self._phase("serialize"):
+            fileobj.write(DECLS_BYTES)
+            etree.ElementTree(self.doc).write(fileobj, xml_declaration=False, pretty_print=pretty, encoding="UTF-8")
+
+
+    @contextmanager
+    def _indented(self, pretty=True):
+        """ Context in which the document is indented, when pretty. The tree is put back as it
+            was afterwards, so that compact output does not depend on earlier pretty output. """
+        if not pretty:
+            yield
+            return
+        changes = []
+        with self._phase("indent"):
+            _indent(self.doc, changes=changes)
+        try:
+            yield
+        finally:
+            with self._phase("indent"):
+                _unindent(changes)
+
+
+    def write_to(self, dest, pretty=True):
+        """ Convert the document and stream it to a file path or a binary file object.
+            Each finished top-level division of <body> is serialized and released from
+            the tree as soon as the conversion has moved past it, so memory stays flat.
+            The bytes written are identical to tostring(pretty). A file at dest is only
+            replaced once the document is complete.
+            The header (and anything following <text>, e.g. <standOff>) must be complete
+            before calling this: see convert_header(). """
+        if isinstance(dest, (str, os.PathLike)):
+            write_atomic(dest, lambda writer: self._stream(writer, pretty))
+        else:
+            self._stream(dest, pretty)
+
+
+    def _stream(self, writer, pretty=True):
+        if self._converted:
+            # Nothing left to stream.
+            self.write(writer, pretty)
+            return
+
+        self.convert_header()
+        prefix, suffix, nsdecls = self._split_template(pretty)
+        separator = SEPARATOR if pretty else b""
+        flushed = 0
+        for child in self._convert_incrementally():
+            child_str = self._serialize_child(child, BODY_LEVEL, nsdecls, pretty)
+            with self._phase("serialize"):
+                writer.write(prefix if flushed == 0 else separator)
+                writer.write(child_str)
+            flushed += 1
+
+        if flushed:
+            writer.write(suffix)
+        else:
+            # Empty body: let lxml serialize it as an empty element.
+            self.write(writer, pretty)
+
+
+    def write_shards(self, dest: str, max_bytes: int, pretty=True) -> List[str]:
+        """ Convert the document and write its <body> to shard files of at most max_bytes
+            each (unless a single top-level division is larger), next to a master file at dest
+            that includes them with xi:include. Like write_to(), each shard is written and
+            released as soon as it is complete. Returns the paths of the shards. """
+        root, ext = os.path.splitext(dest)
+        nsdecls = self._split_template(pretty)[2]
+        separator = b"\n" + SPACE.encode("utf-8") if pretty else b""
+        shard_start = XML_DECL + b"<body" + nsdecls + b">"
+        shard_end = (b"\n" if pretty else b"") + b"</body>\n"
+        shards = []
+        shard = None
+        size = 0
+        try:
+            self.convert_header()
+            for child in self._convert_incrementally():
+                child_str = self._serialize_child(child, 1, nsdecls, pretty)
+                with self._phase("serialize"):
+                    if shard is not None and size + len(separator + child_str + shard_end) > max_bytes:
+                        shard.write(shard_end)
+                        shard.close()
+                        shard = None
+                    if shard is None:
+                        shards.append(f"{root}.{len(shards) + 1:03d}{ext}")
+                        shard = open(shards[-1], "wb")
+                        shard.write(shard_start)
+                        size = len(shard_start)
+                    shard.write(separator + child_str)
+                    size += len(separator + child_str)
+            if shard is not None:
+                shard.write(shard_end)
+                shard.close()
+                shard = None
+
+            # The body of the master file only includes the shards.
+            for shard_path in shards:
+                include = etree.SubElement(self.body, f"{XINS}include")
+                include.set("href", os.path.basename(shard_path))
+                include.set("xpointer", "xpointer(/*/*)")
+            with open(dest, "wb") as writer:
+                self.write(writer, pretty)
+        except Exception:
+            # Do not leave a partial set of files behind.
+            if shard is not None:
+                shard.close()
+            for path in shards + [dest]:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        return shards
+
+
+    def _convert_incrementally(self):
+        """ Convert the body, yielding each top-level child of <body> once the conversion
+            has moved past it. The child is removed from the tree when the caller is done with it. """
+        if self._converted:
+            yield from self._release(0)
+            return
+        with self._phase("convert"):
+            self._convertFirstPage()
+            for pos, content in self._content():
+                self._convertStructure(content, pos)
+                if len(self.body) > 1:
+                    self._flushText()
+                    yield from self._release(1)
+            self._flushText()
+        yield from self._release(0)
+        self._converted = True
+        if self.profile is not None:
+            self.profile.measure(self.doc)
+
+
+    def _release(self, keep: int):
+        """ Yield and then remove the children of <body> but the last keep ones. """
+        # A riwāyāt segment can keep receiving text after its division was left:
+        # never release the division that holds it, until the conversion is over.
+        if keep and self.context_linepart is not None:
+            top = self.context_linepart
+            parent = top.getparent()
+            while parent is not None and parent is not self.body:
+                top = parent
+                parent = top.getparent()
+            if parent is not None:
+                keep = max(keep, len(self.body) - self.body.index(top))
+        if self.profile is not None and len(self.body) > keep:
+            self.profile.measure(self.doc)
+        while len(self.body) > keep:
+            child = self.body[0]
+            yield child
+            if self.profile is not None:
+                self.profile.release(child)
+            self.body.remove(child)
+
+
+    def _serialize_child(self, child: Element, level: int, nsdecls: bytes, pretty=True) -> bytes:
+        """ Serialize a child of <body> on its own, as if it were at the given depth and
+            without the namespace declarations that lxml repeats on it. """
+        if pretty:
+            with self._phase("indent"):
+                _indent(child, level)
+        with self._phase("serialize"):
+            tag = b"<" + etree.QName(child).localname.encode("utf-8")
+            # Pretty printing replaces the tail with the separator.
+            child_str = etree.tostring(child, with_tail=not pretty, encoding="UTF-8")
+            if child_str.startswith(tag + nsdecls):
+                child_str = tag + child_str[len(tag + nsdecls):]
+        return child_str
+
+
+    def _split_template(self, pretty=True):
+        """ Serialize the document around an empty <body> and return the bytes before
+            and after its content, together with the namespace declarations that lxml
+            repeats on any element serialized on its own. """
+        doc = deepcopy(self.doc)
+        body = doc.find(".//tei:body", NS)
+        dummy = etree.SubElement(body, f"{TEINS}div")
+        nsdecls = etree.tostring(dummy, encoding="UTF-8")[len(b"<div"):-len(b"/>")]
+        body.remove(dummy)
+
+        marker = etree.Comment("oitei-stream")
+        body.append(marker)
+        if pretty:
+            _indent(doc)
+        tree_str = etree.tostring(doc, xml_declaration=False, pretty_print=pretty, encoding="UTF-8")
+        prefix, suffix = tree_str.split(etree.tostring(marker, with_tail=False), 1)
+        if pretty:
+            # Drop the indentation that the marker got as last child.
+            suffix = SEPARATOR[:-len(SPACE)] + suffix[len(marker.tail):]
+        return (DECLS_BYTES + prefix, suffix, nsdecls)
 
 
     def _appendText(self, el: Element, text: str):
-        children = el.getchildren()
-        if len(children) > 0:
-            tail = children[-1].tail
-            if tail:
-                children[-1].tail = tail + text
-            else:
-                children[-1].tail = text
-        else:
-            if el.text:
-                el.text = el.text + text
+        """ Add text at the end of el: to the tail of its last child, or to its own text.
+            Text for the same spot is queued and only joined once the spot changes. """
+        target = _last_child(el)
+        if target is None:
+            target = el
+        is_tail = target is not el
+        if target is not self._pending_el or is_tail != self._pending_tail:
+            self._flushText()
+            self._pending_el = target
+            self._pending_tail = is_tail
+        self._pending_text.append(text)
+
+
+    def _flushText(self):
+        """ Write out the text queued by _appendText() """
+        el = self._pending_el
+        if el is not None:
+            text = "".join(self._pending_text)
+            if self._pending_tail:
+                el.tail = el.tail + text if el.tail else text
             else:
-                el.text = text
+                el.text = el.text + text if el.text else text
+            self._pending_el = None
+            self._pending_text = []
+
+
+    def _index_pagenums(self, content: List = None, after=None):
+        """ Map every position of content (by default, the document's) to the first PageNumber
+            found at or after it, or else to after, the one following the content.
+            Built once, walking the content backwards, so that look-ups are O(1). """
+        if content is None:
+            content = self.md.content
+        index = [None] * len(content) + [after]
+        next_pagenum = after
+        for pos in range(len(content) - 1, -1, -1):
+            c = content[pos]
+            if isinstance(c, PageNumber):
+                next_pagenum = self._index_entry(c)
+            elif isinstance(c, Line):
+                for lp in c.parts:
+                    if isinstance(lp, PageNumber):
+                        next_pagenum = self._index_entry(lp)
+                        break
+            index[pos] = next_pagenum
+        return index
+
+
+    def _index_entry(self, pagenum: PageNumber):
+        """ In low-memory mode, the index holds copies of the page numbers, allocated apart from
+            the parsed document: a page number kept every few lines would keep the memory of
+            all of them from being freed. """
+        if not self.low_memory:
+            return pagenum
+        return PageRef(pagenum.volume.encode().decode(), pagenum.page.encode().decode())
+
+
+    def _first_pagenum(self, content: List):
+        for c in content:
+            if isinstance(c, PageNumber):
+                return self._index_entry(c)
+            if isinstance(c, Line):
+                for lp in c.parts:
+                    if isinstance(lp, PageNumber):
+                        return self._index_entry(lp)
 
 
     def _pagenum_lookdown(self, pos):
-        for c in self.md.content[pos:]:
-            if isinstance(c, PageNumber) or isinstance(c, Line):
-                if isinstance(c, Line):
-                    for lp in c.parts:
-                        if isinstance(lp, PageNumber):
-                            return lp
-                elif isinstance(c, PageNumber):
-                    return c
+        pos -= self._index_offset
+        if pos < len(self._pagenum_index):
+            return self._pagenum_index[pos]
 
 
     def _create_pb(self, c):
@@ -116,7 +703,180 @@ class Converter:
             pb.set("n", value)
 
 
-    def convert(self):
+    def convert(self, jobs=1):
+        """ Convert the document. With jobs > 1, a large document is split at top-level
+            sections and the parts are converted by that many processes (not in low-memory mode). """
+        self.convert_header()
+        with self._phase("convert"):
+            chunks = self._chunks(jobs) if jobs > 1 and not self.low_memory else None
+            if not chunks or not self._convert_parallel(chunks, jobs):
+                self._convertFirstPage()
+
+                # Process content
+                for pos, content in self._content():
+                    self._convertStructure(content, pos)
+                self._flushText()
+        self._converted = True
+        if self.profile is not None:
+            self.profile.measure(self.doc)
+
+
+    def _content(self):
+        """ Iterate over the (position, structure) pairs to convert. In low-memory mode, the
+            content list of the document is used as a queue and is empty once the conversion is
+            over: only the structure before the current one is kept, for _convertLine().
+            Page numbers are looked up in the index built beforehand (see _index_pagenums()). """
+        if not self.low_memory:
+            return enumerate(self.md.content)
+        return self._consume()
+
+
+    def _consume(self):
+        queue = self.md.content
+        # Before the first structure comes the last one, as with content[pos - 1].
+        # The last one of a document read in chunks is not known yet.
+        if queue and self._next_chunks is None:
+            self._lookback = queue[-1]
+        pos = 0
+        while True:
+            # Popping from the end of the list is O(1).
+            queue.reverse()
+            while queue:
+                content = queue.pop()
+                yield pos, content
+                self._lookback = content
+                pos += 1
+            chunk = next(self._next_chunks, None) if self._next_chunks is not None else None
+            if chunk is None:
+                break
+            queue, self._pagenum_index = chunk
+            self.md.content = queue
+            self._index_offset = pos
+
+
+    def _chunks(self, jobs: int): # -> list[tuple[int, int, bool]]: (needs >python3.9)
+        """ Split the content in ranges (start, end, open seg) that a converter starting from
+            an empty <body> converts as the whole conversion would. A range starts at a
+            top-level section header that opens a new <div>, i.e. unless the previous one only
+            holds its <head> and page breaks. "open seg" tells whether a riwāyāt segment
+            is still receiving text when the range starts (see _convertTextPart()). """
+        content = self.md.content
+        count = min(2 * jobs, len(content) // MIN_CHUNK)
+        if count < 2:
+            return []
+
+        starts = []
+        opens_div = True
+        for pos, c in enumerate(content):
+            if type(c) is SectionHeader and c.level == 1:
+                if opens_div:
+                    starts.append(pos)
+                opens_div = False
+            elif not isinstance(c, PageNumber) and self.structure_handlers.get(type(c)) is not None:
+                opens_div = True
+        # The section headers closest to an even split.
+        bounds = []
+        for i in range(1, count):
+            j = bisect_left(starts, i * len(content) // count)
+            if j < len(starts) and starts[j] > (bounds[-1] if bounds else 0):
+                bounds.append(starts[j])
+        if not bounds:
+            return []
+
+        # Text parts go to the last riwāyāt segment, until a line part without a handler.
+        open_seg = []
+        is_open = False
+        b = 0
+        for pos, c in enumerate(content):
+            if b < len(bounds) and pos == bounds[b]:
+                open_seg.append(is_open)
+                b += 1
+            if isinstance(c, Line):
+                for part in c.parts:
+                    if self.part_handlers.get(type(part)) is None:
+                        is_open = False
+                    elif isinstance(part, RIWAYAT_PARTS):
+                        is_open = True
+
+        starts = [0] + bounds
+        ends = bounds + [len(content)]
+        return list(zip(starts, ends, [False] + open_seg))
+
+
+    def _convert_parallel(self, chunks, jobs: int) -> bool:
+        """ Convert the chunks in worker processes and add their content to <body>.
+            Returns False, leaving the tree untouched, when a chunk did not end as expected
+            by the next one, e.g. because of a handler registered by the user. """
+        # Only imported by parallel conversions, as it is slow to import.
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        global _shared
+        shared = (type(self), self.md.magic_value, self.md.content, self._pagenum_index,
+                  self.structure_handlers, self.part_handlers)
+        profile = self.profile is not None
+        # Forked workers inherit the document; otherwise each one is sent its chunk.
+        fork = "fork" in multiprocessing.get_all_start_methods()
+        tasks = []
+        for start, end, open_seg in chunks:
+            if fork:
+                tasks.append((start, end, start == 0, open_seg, profile, None))
+            else:
+                chunk = shared[:2] + (shared[2][start:end], shared[3][start:end + 1]) + shared[4:]
+                tasks.append((0, end - start, start == 0, open_seg, profile, chunk))
+        context = multiprocessing.get_context("fork") if fork else None
+        _shared = shared
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+                results = list(pool.map(_convert_chunk, tasks))
+        finally:
+            _shared = None
+
+        def give_up():
+            logger.info("Parallel conversion does not apply to this document: converting it in one process.")
+            return False
+
+        bodies = [etree.fromstring(result["body"]) for result in results]
+        linepart = None
+        for k, (result, body) in enumerate(zip(results, bodies)):
+            if (k > 0 and results[k - 1]["open_section"]) or chunks[k][2] != (linepart is not None):
+                return give_up()
+            text = result["linepart_text"]
+            if text is not None:
+                if len(linepart):
+                    return give_up()
+                linepart.text = linepart.text + text if linepart.text else text
+            if result["linepart"] is None:
+                linepart = None
+            elif result["linepart"] == "detached":
+                return give_up()
+            elif result["linepart"] != "incoming":
+                linepart = body
+                for i in result["linepart"]:
+                    linepart = linepart[i]
+
+        for result, body in zip(results, bodies):
+            for el in body.xpath(f".//*[@{EMPTY_TEXT}]"):
+                del el.attrib[EMPTY_TEXT]
+                el.text = ""
+            self.body.extend(list(body))
+            if self.profile is not None:
+                self.profile.structures.update(result["structures"])
+                self.profile.parts.update(result["parts"])
+        self.context_linepart = linepart
+        return True
+
+
+    def convert_header(self):
+        """ Fill in the teiHeader. Called by convert() and write_to(), or beforehand
+            by callers that need to add to the header before the body is converted. """
+        if self._header_converted:
+            return
+        self._header_converted = True
+        with self._phase("header"):
+            self._convertHeader()
+
+
+    def _convertHeader(self):
         # Set up TEI document from a minimal string template
         teiHeader = self.doc.find(".//tei:teiHeader", NS)
 
@@ -148,322 +908,374 @@ class Converter:
             xenoData.text = xenoString 
             teiHeader.append(xenoData)
 
+
+    def _convertFirstPage(self):
         # If there are page numbers, the first one needs to be placed at the beginning
         # of the document because TEI marks page beginnings, not endings.
         pb = self._pagenum_lookdown(0)
         if pb:
             self._create_pb(pb)
 
-        # Process content
-        for pos, content in enumerate(self.md.content):
-            self._convertStructure(content, pos)
-        
 
     def _convertStructure(self, content, pos):
         """Convert an oimdp.Content object to a TEI element"""
+        handler = self.structure_handlers.get(type(content))
+        if handler is not None:
+            if handler not in self._builtin_handlers:
+                self._flushText()
+            handler(self, content, pos)
 
-        PARALIKE = [f"{TEINS}p", f"{TEINS}ab", f"{TEINS}entryFree", f"{TEINS}lg"]
 
-        def _set_closest_container():
-            """ set the context node to closest div or body """
-            if self.context_node.tag != f"{TEINS}body":
-                # Locate closest div
-                closest = self.context_node.xpath("ancestor::tei:div[not(@type)]", namespaces=NS)
+    def _convertPart(self, content, cur_pos):
+        """ Convert line parts """ 
+        handler = self.part_handlers.get(type(content))
+        if handler is not None:
+            if handler not in self._builtin_handlers:
+                self._flushText()
+            handler(self, content, cur_pos)
+        else:
+            self.context_linepart = None
 
-                if len(closest):
-                    self.context_node = closest[-1]
-                else:
-                    # Return to body
-                    self.context_node = self.body
 
-        def _set_closest_container_for_paralike():
-            """ set the context node to closest usable div. """
+    def _set_closest_container(self):
+        """ set the context node to closest div or body """
+        if self.context_node.tag != f"{TEINS}body":
+            # Locate closest div
+            closest = self._closest_section()
 
-            def _create(ctx):
-                div = etree.SubElement(ctx, f"{TEINS}div")
-                self.context_node = div
+            if closest is not None:
+                self.context_node = closest
+            else:
+                # Return to body
+                self.context_node = self.body
+
+
+    def _set_closest_container_for_paralike(self):
+        """ set the context node to closest usable div. """
+
+        def _create(ctx):
+            div = etree.SubElement(ctx, f"{TEINS}div")
+            self.context_node = div
+
+        if self.context_node.tag == f"{TEINS}div":
+            last = _last_child(self.context_node)
+            # Paragraph-like elements must not be preceded by divs.
+            if last is not None and last.tag == f"{TEINS}div":
+                _create(self.context_node)
 
-            if self.context_node.tag == f"{TEINS}div":
-                children = self.context_node.getchildren()
+        else:                
+            # Locate closest div like structure
+            closest = self._closest_div()
+
+            if closest is not None:
+                last = _last_child(closest)
                 # Paragraph-like elements must not be preceded by divs.
-                if len(children) and children[-1].tag == f"{TEINS}div":
-                    _create(self.context_node)
-
-            else:                
-                # Locate closest div like structure
-                closest = self.context_node.xpath("ancestor::tei:div", namespaces=NS)
-
-                if len(closest):
-                    children = closest[-1].getchildren()
-                    # Paragraph-like elements must not be preceded by divs.
-                    if len(children) and children[-1].tag != f"{TEINS}div":
-                        self.context_node = closest[-1]
-                    else:
-                        _create(self.body)
+                if last is not None and last.tag != f"{TEINS}div":
+                    self.context_node = closest
                 else:
                     _create(self.body)
+            else:
+                _create(self.body)
 
-        def _create_p(tag="p", attributes={}):
-            _set_closest_container_for_paralike()
-            el = etree.SubElement(self.context_node, f"{TEINS}{tag}")
-            if attributes:
-                for att in attributes:
-                    el.set(att, attributes[att]) 
-            self.context_node = el
-
-        # Riwāyāt
-        if isinstance(content, Riwayat):
-            _create_p(tag="ab", attributes={"type": "rwy"})
-
-        elif isinstance(content, Paragraph):
-            _create_p()
-
-        elif isinstance(content, PageNumber):
-            # PageNumber typically marks the end of a page, while TEI marks the beginning.
-            # We need to do a look-up to move the page to the right location.
-            next_pagenum = self._pagenum_lookdown(pos + 1)
-            if next_pagenum:
-                self._create_pb(next_pagenum)
-
-        elif isinstance(content, Verse):
-            if self.context_node.tag != f"{TEINS}lg":
-                _set_closest_container_for_paralike()
-                self.context_node = etree.SubElement(self.context_node, f"{TEINS}lg")
-            
-            self.context_node = etree.SubElement(self.context_node, f"{TEINS}l")
-
-            if len(content.parts) > 0:
-                for part in content.parts:
-                    self._convertPart(part, pos)
-                self._appendText(self.context_node, "\n")
-            self.context_node = self.context_node.getparent()
-
-        elif isinstance(content, Line):
-            addlinebreak = True
-            # Lines after certain structure markers are headers
-            prev = self.md.content[pos - 1]
-            if (
-                isinstance(prev, BioOrEvent) or 
-                isinstance(prev, DictionaryUnit) or
-                isinstance(prev, DoxographicalItem)
-            ) and self.context_node.tag == f"{TEINS}div":
-                self.context_node = etree.SubElement(self.context_node, f"{TEINS}head")
-                addlinebreak = False
+
+    def _create_p(self, tag="p", attributes={}):
+        self._set_closest_container_for_paralike()
+        el = etree.SubElement(self.context_node, f"{TEINS}{tag}")
+        if attributes:
+            for att in attributes:
+                el.set(att, attributes[att]) 
+        self.context_node = el
+
+
+    # Structures
+
+    def _convertRiwayat(self, content, pos):
+        self._create_p(tag="ab", attributes={"type": "rwy"})
+
+
+    def _convertParagraph(self, content, pos):
+        self._create_p()
+
+
+    def _convertPageNumber(self, content, pos):
+        # PageNumber typically marks the end of a page, while TEI marks the beginning.
+        # We need to do a look-up to move the page to the right location.
+        next_pagenum = self._pagenum_lookdown(pos + 1)
+        if next_pagenum:
+            self._create_pb(next_pagenum)
+
+
+    def _convertVerse(self, content, pos):
+        if self.context_node.tag != f"{TEINS}lg":
+            self._set_closest_container_for_paralike()
+            self.context_node = etree.SubElement(self.context_node, f"{TEINS}lg")
+        
+        self.context_node = etree.SubElement(self.context_node, f"{TEINS}l")
+
+        if len(content.parts) > 0:
+            for part in content.parts:
+                self._convertPart(part, pos)
+            self._appendText(self.context_node, "\n")
+        self.context_node = self.context_node.getparent()
+
+
+    def _convertLine(self, content, pos):
+        addlinebreak = True
+        # Lines after certain structure markers are headers
+        prev = self._lookback if self.low_memory else self.md.content[pos - 1]
+        if (
+            isinstance(prev, BioOrEvent) or 
+            isinstance(prev, DictionaryUnit) or
+            isinstance(prev, DoxographicalItem)
+        ) and self.context_node.tag == f"{TEINS}div":
+            self.context_node = etree.SubElement(self.context_node, f"{TEINS}head")
+            addlinebreak = False
+        else:
+            if self.context_node.tag not in PARALIKE:
+                self._create_p()
+            etree.SubElement(self.context_node, f"{TEINS}lb")
+
+        # Process line parts
+        if len(content.parts) > 0:
+            for part in content.parts:
+                self._convertPart(part, pos)
+
+        if addlinebreak:
+            self._appendText(self.context_node, "\n")                
+
+    def _convertSectionHeader(self, content, pos):
+        # make sure this isn't used as a closing tag to resume content in the previous div.
+        # (no value or empty string value)
+        # Removing this temporarily since this behavior seems to be implemented inconsistently.
+        # val = content.value or ""
+        # if "".join(val.split()) == "":
+        #     closest = self.context_node.xpath("ancestor::tei:div[not(@type)] | ancestor::tei:body", namespaces=NS)
+        #     if len(closest):
+        #         if self.context_node.tag == f"{TEINS}div":
+        #             self.context_node = closest[-1]
+        #         else:
+        #             self.context_node = closest[-2]
+        #     return
+        
+        # make sure we are in a section (untyped) div ...
+        if self.context_node.tag != f"{TEINS}div" or self.context_node.get("type"):
+            # ... or find the closest ...
+            closest = None
+            if self.context_node is not self.body:
+                closest = self._closest_section()
+                if closest is None:
+                    closest = self.body
+            if closest is not None:
+                self.context_node = closest
             else:
-                if self.context_node.tag not in PARALIKE:
-                    _create_p()
-                etree.SubElement(self.context_node, f"{TEINS}lb")
-
-            # Process line parts
-            if len(content.parts) > 0:
-                for part in content.parts:
-                    self._convertPart(part, pos)
-
-            if addlinebreak:
-                self._appendText(self.context_node, "\n")                
-
-        elif isinstance(content, SectionHeader):
-            # make sure this isn't used as a closing tag to resume content in the previous div.
-            # (no value or empty string value)
-            # Removing this temporarily since this behavior seems to be implemented inconsistently.
-            # val = content.value or ""
-            # if "".join(val.split()) == "":
-            #     closest = self.context_node.xpath("ancestor::tei:div[not(@type)] | ancestor::tei:body", namespaces=NS)
-            #     if len(closest):
-            #         if self.context_node.tag == f"{TEINS}div":
-            #             self.context_node = closest[-1]
-            #         else:
-            #             self.context_node = closest[-2]
-            #     return
-            
-            # make sure we are in a section (untyped) div ...
-            if self.context_node.tag != f"{TEINS}div" or self.context_node.get("type"):
-                # ... or find the closest ...
-                closest = self.context_node.xpath("ancestor::tei:div[not(@type)] | ancestor::tei:body", namespaces=NS)
-                if len(closest):
-                    self.context_node = closest[-1]
-                else:
-                    # ... or create it.
-                    self.context_node = etree.SubElement(self.context_node, f"{TEINS}div")
-            
-            # Check level
-            cur_level = len(self.context_node.xpath("ancestor-or-self::tei:div[not(@type)]", namespaces=NS))
-            level_diff = content.level - cur_level
-
-            def _is_viable(container):
-                """  check that the <div> is either empty or only contains lb, pb, or head """
-                allowed_children = [f"{TEINS}lb", f"{TEINS}pb", f"{TEINS}head"]
-                children = container.getchildren()
-                if len(children):
-                    for child in children:
-                        if child.tag not in allowed_children:
-                            return False
-                return True
-
-            if level_diff == 0 and not _is_viable(self.context_node):
-                # Check viability or step up up a level and create new div
-                _set_closest_container()
+                # ... or create it.
+                self.context_node = etree.SubElement(self.context_node, f"{TEINS}div")
+        
+        # Check level
+        cur_level = self._section_level()
+        level_diff = content.level - cur_level
+
+        if level_diff == 0 and not _is_viable(self.context_node):
+            # Check viability or step up up a level and create new div
+            self._set_closest_container()
+            self.context_node = etree.SubElement(self.context_node, f"{TEINS}div")
+        elif level_diff > 0:
+            # Needs nesting.
+            for step in range(level_diff):
                 self.context_node = etree.SubElement(self.context_node, f"{TEINS}div")
-            elif level_diff > 0:
-                # Needs nesting.
-                for step in range(level_diff):
+        else:
+            # Needs to step out by the level difference.
+            # try: 
+            ancestor = self._section_ancestor(level_diff)
+            if ancestor is not None:
+                self.context_node = ancestor
+                if not _is_viable(ancestor):
+                    self._set_closest_container()
                     self.context_node = etree.SubElement(self.context_node, f"{TEINS}div")
-            else:
-                # Needs to step out by the level difference.
-                # try: 
-                ancestors = self.context_node.xpath("ancestor::tei:div[not(@type)]", namespaces=NS)
-                if len(ancestors):
-                    ancestor = ancestors[level_diff]
-                    if ancestor is not None:
-                        self.context_node = ancestor
-                        if not _is_viable(ancestor):
-                            _set_closest_container()
-                            self.context_node = etree.SubElement(self.context_node, f"{TEINS}div")
-
-            head = etree.SubElement(self.context_node, f"{TEINS}head")
-            head.text = content.value.strip()
-
-        # elif isinstance(content, AdministrativeRegion):
-            #TODO IN PARSER!
+
+        head = etree.SubElement(self.context_node, f"{TEINS}head")
+        head.text = content.value.strip()
+
+
+    def _convertBioOrEvent(self, content, pos):
+        self._set_closest_container()
             
-        elif isinstance(content, BioOrEvent):
-            _set_closest_container()
-                
-            div = etree.SubElement(self.context_node, f"{TEINS}div")
-
-            if content.be_type == "wom":
-                div.set("type", "biography")
-                div.set("subtype", "woman")
-            elif content.be_type == "man":
-                div.set("type", "biography")
-                div.set("subtype", "man")                
-            elif content.be_type == "ref":
-                div.set("type", "biography")
-                div.set("subtype", "ref_or_rep")
-            elif content.be_type == "names":
-                div.set("type", "names")
-            elif content.be_type == "event":
-                div.set("type", "event")
-            elif content.be_type == "events":
-                div.set("type", "events")
-        
-            self.context_node = div
+        div = etree.SubElement(self.context_node, f"{TEINS}div")
+
+        if content.be_type == "wom":
+            div.set("type", "biography")
+            div.set("subtype", "woman")
+        elif content.be_type == "man":
+            div.set("type", "biography")
+            div.set("subtype", "man")                
+        elif content.be_type == "ref":
+            div.set("type", "biography")
+            div.set("subtype", "ref_or_rep")
+        elif content.be_type == "names":
+            div.set("type", "names")
+        elif content.be_type == "event":
+            div.set("type", "event")
+        elif content.be_type == "events":
+            div.set("type", "events")
+    
+        self.context_node = div
 
-        elif isinstance(content, DictionaryUnit):
-            _set_closest_container_for_paralike()
-                
-            ef = etree.SubElement(self.context_node, f"{TEINS}entryFree")
-
-            if content.dic_type == "bib":
-                ef.set("type", "bib")
-            elif content.dic_type == "lex":
-                ef.set("type", "lex")
-            elif content.dic_type == "nis":
-                ef.set("type", "nis")
-            elif content.dic_type == "top":
-                ef.set("type", "top")
-        
-            self.context_node = ef
-        elif isinstance(content, DoxographicalItem):
-            _set_closest_container()
 
-            div = etree.SubElement(self.context_node, f"{TEINS}div")
-            div.set("type", "doxographical")
+    def _convertDictionaryUnit(self, content, pos):
+        self._set_closest_container_for_paralike()
+            
+        ef = etree.SubElement(self.context_node, f"{TEINS}entryFree")
+
+        if content.dic_type == "bib":
+            ef.set("type", "bib")
+        elif content.dic_type == "lex":
+            ef.set("type", "lex")
+        elif content.dic_type == "nis":
+            ef.set("type", "nis")
+        elif content.dic_type == "top":
+            ef.set("type", "top")
+    
+        self.context_node = ef
 
-            if content.dox_type == "pos":
-                div.set("subtype", "pos")
-            elif content.dox_type == "sec":
-                div.set("subtype", "sec")
 
-            self.context_node = div
-        elif isinstance(content, Editorial):
-            _set_closest_container()
+    def _convertDoxographicalItem(self, content, pos):
+        self._set_closest_container()
 
-            div = etree.SubElement(self.context_node, f"{TEINS}div")
-            div.set("type", "editorial")
+        div = etree.SubElement(self.context_node, f"{TEINS}div")
+        div.set("type", "doxographical")
 
-            self.context_node = div
+        if content.dox_type == "pos":
+            div.set("subtype", "pos")
+        elif content.dox_type == "sec":
+            div.set("subtype", "sec")
 
-    def _convertPart(self, content, cur_pos):
-        """ Convert line parts """ 
-        if isinstance(content, Isnad) or isinstance(content, Matn) or isinstance(content, Hukm):
-            parts = {
-                "Isnad": "isn",
-                "Matn": "matn",
-                "Hukm": "hukm",
-            }
-
-            if self.context_node.tag != f"{TEINS}ab":
-                raise Exception("Riwāyāt part not in Riwāyāt")
-            
-            seg = etree.SubElement(self.context_node, f"{TEINS}seg")
-            part_type = parts.get(type(content).__name__)
-            seg.set("type", part_type)
-            
-            self.context_linepart = seg
+        self.context_node = div
 
-        elif isinstance(content, Hemistich):
-            if self.context_node.tag != f"{TEINS}l":
-                raise Exception("Hemistic outside of Verse structure")
-            else:
-                c = etree.SubElement(self.context_node, f"{TEINS}caesura")
-                c.tail = " "
 
-        elif isinstance(content, Milestone):
-            milestone = etree.SubElement(self.context_node, f"{TEINS}milestone")
-            milestone.set("n", "300")
-            milestone.set("unit", "words")
-            
-        elif isinstance(content, Date):
-            date = etree.SubElement(self.context_node, f"{TEINS}date")
-            date.set("type", content.date_type)
-            date.set("calendar", "#ah")
-            date.set("when-custom", content.value)
-            date.tail = " "
-        elif isinstance(content, Age):
-            num = etree.SubElement(self.context_node, f"{TEINS}num")
-            num.set("type", "age")
-            num.set("value", content.value)
-            num.tail = " "
-        elif isinstance(content, NamedEntity):
-            self._appendText(self.context_node, " ")
-            text_to_add = content.text
-            if content.prefix > 0:
-                pre = content.text[:content.prefix]
-                self._appendText(self.context_node, pre)
-                text_to_add = content.text[content.prefix:]
-            if content.ne_type == "soc":
-                seg = etree.SubElement(self.context_node, f"{TEINS}seg")
-                seg.set("type", "biochar")
-                seg.text = text_to_add
-                seg.tail = " "
-            elif content.ne_type == "top":
-                pn = etree.SubElement(self.context_node, f"{TEINS}placeName")
-                pn.text = text_to_add
-                pn.tail = " "
-            elif content.ne_type == "per":
-                pn = etree.SubElement(self.context_node, f"{TEINS}persName")
-                pn.text = text_to_add
-                pn.tail = " "
-            elif content.ne_type == "src":
-                pn = etree.SubElement(self.context_node, f"{TEINS}persName")
-                pn.set("role", "source")
-                pn.text = text_to_add
-                pn.tail = " "
-
-        elif isinstance(content, TextPart):
-            node = self.context_node
-            if self.context_linepart is not None:
-                node = self.context_linepart
-
-            self._appendText(node, content.orig.strip())
-
-        elif isinstance(content, PageNumber):
-            # PageNumber typically marks the end of a page, while TEI marks the beginning.
-            # We need to do a look-up to move the page to the right location.
-            next_pagenum = self._pagenum_lookdown(cur_pos + 1)
-            if next_pagenum:
-                self._create_pb(next_pagenum)
+    def _convertEditorial(self, content, pos):
+        self._set_closest_container()
+
+        div = etree.SubElement(self.context_node, f"{TEINS}div")
+        div.set("type", "editorial")
+
+        self.context_node = div
+
+    # TODO: AdministrativeRegion (IN PARSER!)
+
+
+    # Line parts
+
+    def _convertRiwayatPart(self, content, cur_pos):
+        parts = {
+            "Isnad": "isn",
+            "Matn": "matn",
+            "Hukm": "hukm",
+        }
+
+        if self.context_node.tag != f"{TEINS}ab":
+            raise Exception("Riwāyāt part not in Riwāyāt")
+        
+        seg = etree.SubElement(self.context_node, f"{TEINS}seg")
+        part_type = parts.get(type(content).__name__)
+        seg.set("type", part_type)
+        
+        self.context_linepart = seg
+
 
+    def _convertHemistich(self, content, cur_pos):
+        if self.context_node.tag != f"{TEINS}l":
+            raise Exception("Hemistic outside of Verse structure")
         else:
-            self.context_linepart = None
\ No newline at end of file
+            c = etree.SubElement(self.context_node, f"{TEINS}caesura")
+            c.tail = " "
+
+
+    def _convertMilestone(self, content, cur_pos):
+        milestone = etree.SubElement(self.context_node, f"{TEINS}milestone")
+        milestone.set("n", "300")
+        milestone.set("unit", "words")
+
+
+    def _convertDate(self, content, cur_pos):
+        date = etree.SubElement(self.context_node, f"{TEINS}date")
+        date.set("type", content.date_type)
+        date.set("calendar", "#ah")
+        date.set("when-custom", content.value)
+        date.tail = " "
+
+
+    def _convertAge(self, content, cur_pos):
+        num = etree.SubElement(self.context_node, f"{TEINS}num")
+        num.set("type", "age")
+        num.set("value", content.value)
+        num.tail = " "
+
+
+    def _convertNamedEntity(self, content, cur_pos):
+        self._appendText(self.context_node, " ")
+        text_to_add = content.text
+        if content.prefix > 0:
+            pre = content.text[:content.prefix]
+            self._appendText(self.context_node, pre)
+            text_to_add = content.text[content.prefix:]
+        if content.ne_type == "soc":
+            seg = etree.SubElement(self.context_node, f"{TEINS}seg")
+            seg.set("type", "biochar")
+            seg.text = text_to_add
+            seg.tail = " "
+        elif content.ne_type == "top":
+            pn = etree.SubElement(self.context_node, f"{TEINS}placeName")
+            pn.text = text_to_add
+            pn.tail = " "
+        elif content.ne_type == "per":
+            pn = etree.SubElement(self.context_node, f"{TEINS}persName")
+            pn.text = text_to_add
+            pn.tail = " "
+        elif content.ne_type == "src":
+            pn = etree.SubElement(self.context_node, f"{TEINS}persName")
+            pn.set("role", "source")
+            pn.text = text_to_add
+            pn.tail = " "
+
+
+    def _convertTextPart(self, content, cur_pos):
+        node = self.context_node
+        if self.context_linepart is not None:
+            node = self.context_linepart
+
+        self._appendText(node, content.orig.strip())
+
+
+    # Handlers are called as handler(converter, content, pos).
+    # Register more with oitei.register_structure() and oitei.register_part(),
+    # or give an instance its own registries with .copy().
+    structure_handlers = HandlerRegistry({
+        Riwayat: _convertRiwayat,
+        Paragraph: _convertParagraph,
+        PageNumber: _convertPageNumber,
+        Verse: _convertVerse,
+        Line: _convertLine,
+        SectionHeader: _convertSectionHeader,
+        BioOrEvent: _convertBioOrEvent,
+        DictionaryUnit: _convertDictionaryUnit,
+        DoxographicalItem: _convertDoxographicalItem,
+        Editorial: _convertEditorial,
+    })
+
+    part_handlers = HandlerRegistry({
+        Isnad: _convertRiwayatPart,
+        Matn: _convertRiwayatPart,
+        Hukm: _convertRiwayatPart,
+        Hemistich: _convertHemistich,
+        Milestone: _convertMilestone,
+        Date: _convertDate,
+        Age: _convertAge,
+        NamedEntity: _convertNamedEntity,
+        TextPart: _convertTextPart,
+        # PageNumber can be a line part as well as a structure.
+        PageNumber: _convertPageNumber,
+    })
+
+    # Built-in handlers add text with _appendText(), which queues it. The queued text is written
+    # out before any other handler is called, so that it sees the text and tails of the tree.
+    _builtin_handlers = frozenset(structure_handlers.values()) | frozenset(part_handlers.values())
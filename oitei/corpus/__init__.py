@@ -1,9 +1,13 @@
 from .corpus import convert_corpus as cc
+from .sitemap import load_sitemap
 
-def convert_corpus(path: str, output="tei"):
-  cc(path, output)
+def convert_corpus(path: str, output="tei", stream=False, jobs=1, incremental=False, profile=False, parse_cache=None,
+                   shard_size=None, book_jobs=1, pipeline=False, result_cache=None, result_cache_size=None):
+  return cc(path, output, stream, jobs, incremental, profile, parse_cache, shard_size, book_jobs, pipeline,
+            result_cache, result_cache_size)
 
 
 __all__ = [
   'convert_corpus',
+  'load_sitemap',
 ]
@@ -1,34 +1,55 @@
 import sys
 import os
 import re
+import json
 import shutil
 import logging
 import traceback
-from typing import List
+from functools import partial
+from itertools import repeat
+from typing import Dict, List, Optional, TypedDict
 from lxml.etree import Element
 from lxml import etree
-from .makeauthor import make_author_record_str
-from .makebook import make_book_record_str
+from .makeauthor import make_author_record_bytes
+from .makebook import make_book_record_bytes
 from .makeversion import make_version_record, VersionRecord
 from .makesite import makesite, makesite_local
+from .sitemap import Sitemap, SITEMAP
+from .pipeline import BackgroundWriter, prefetch, write_file
+from .manifest import hash_inputs, load_manifest, save_manifest, reusable_files, is_up_to_date, remove_stale_outputs
+from .fileindex import CorpusIndex, version_yml_name
+from oitei import __version__
 from oitei.converter import Metadata, Converter
+from oitei.profiling import aggregate
+from oitei.parsecache import ParseCache
+from oitei.resultcache import ResultCache
 from oitei.namespaces import NS, XINS, TEINS
 from openiti.helper.yml import readYML, check_yml_completeness
-from openiti.helper.funcs import get_all_text_files_in_folder, get_all_yml_files_in_folder
 from datetime import datetime
 import tempfile
+# openiti.helper.funcs and multiprocessing are slow to import: they are imported where needed.
 
 
-now = datetime.now()
-date_time = now.strftime("%m-%d-%Y_%H%M%S")
-tmp = tempfile.gettempdir()
-LOGFILE = f"oitei-{date_time}.log"
-LOGFILEPATH = os.path.join(tmp, LOGFILE)
+# Set by setup_logging()
+LOGFILE = None
+LOGFILEPATH = None
+PROFILE = "oitei-profile.json"
 
-logging.basicConfig(filename=LOGFILEPATH, filemode='w', format='%(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def setup_logging() -> str:
+    """Log to a timestamped file in the temporary folder, which convert_corpus copies to its
+    output folder. Done by the first run rather than on import. Returns the path of the log."""
+    global LOGFILE, LOGFILEPATH
+    if LOGFILEPATH is None:
+        date_time = datetime.now().strftime("%m-%d-%Y_%H%M%S")
+        LOGFILE = f"oitei-{date_time}.log"
+        LOGFILEPATH = os.path.join(tempfile.gettempdir(), LOGFILE)
+        logging.basicConfig(filename=LOGFILEPATH, filemode='w', format='%(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    return LOGFILEPATH
+
+
 def cleanup_nbsp(text: str) -> str:
     if text[0] == "﻿":
         return text[1:]
@@ -64,17 +85,18 @@ def link_metadata(auth: str, book: str, doc: Element) -> Element:
     return doc
 
 
-def process_author_metadata(p:str, dest: str): # -> tuple[str, str, str]: (needs >python3.9)
+def process_author_metadata(p:str, dest: str, writer: BackgroundWriter = None): # -> tuple[str, str, str]: (needs >python3.9)
     return process_metadata(p, dest,
-        "AUTH", ["10#AUTH#ISM####AR:", "10#AUTH#LAQAB##AR:"], make_author_record_str)
+        "AUTH", ["10#AUTH#ISM####AR:", "10#AUTH#LAQAB##AR:"], make_author_record_bytes, writer)
 
 
-def process_book_metadata(p: str, dest: str): # -> tuple[str, str, str]: (needs >python3.9)
+def process_book_metadata(p: str, dest: str, writer: BackgroundWriter = None): # -> tuple[str, str, str]: (needs >python3.9)
     return process_metadata(p, dest,
-        "BOOK", ["10#BOOK#TITLEA#AR:", "10#BOOK#TITLEB#AR:"], make_book_record_str)
+        "BOOK", ["10#BOOK#TITLEA#AR:", "10#BOOK#TITLEB#AR:"], make_book_record_bytes, writer)
 
 
-def process_metadata(p: str, dest: str, mtype: str, fields: List[str], fn): # -> tuple[str, str]: (needs >python3.9)
+def process_metadata(p: str, dest: str, mtype: str, fields: List[str], fn,
+                     writer: BackgroundWriter = None): # -> tuple[str, str]: (needs >python3.9)
     yml = readYML(p, reflow=True) # NB Reflow isn't working at the moment.
     record = fn(yml)
     uri = yml.get(f"00#{mtype}#URI######:").strip()
@@ -87,25 +109,62 @@ def process_metadata(p: str, dest: str, mtype: str, fields: List[str], fn): # ->
 
     # Write out
     output = os.path.join(dest, os.path.basename(p)).replace(".yml", "") + ".xml"
-    with open(output, "w") as writer:
-        writer.write(record)
+    write_file(output, record, writer)
 
     return (uri, value, output) 
 
 
-def determine_folder_structure_for_file(fp: str, output: str): # -> tuple[str, str]: (needs >python3.9)
+class MetadataCache:
+    """Author and book records processed during a run, keyed by YAML path and modification time,
+    so that each record is read, built and written out only once.
+    With a writer, records are written out in the background (see oitei.corpus.pipeline)."""
+    def __init__(self, records=None, writer: BackgroundWriter = None):
+        self.records = records or {}
+        self.writer = writer
+
+    @staticmethod
+    def key(kind: str, p: str): # -> tuple[str, str, int]: (needs >python3.9)
+        return (kind, p, os.stat(p).st_mtime_ns)
+
+    def author(self, p: str, dest: str): # -> tuple[str, str, str]: (needs >python3.9)
+        return self._get("author", p, dest)
+
+    def book(self, p: str, dest: str): # -> tuple[str, str, str]: (needs >python3.9)
+        return self._get("book", p, dest)
+
+    def _get(self, kind: str, p: str, dest: str):
+        key = self.key(kind, p)
+        if key not in self.records:
+            self.records[key] = _process_record((kind, p, dest), self.writer)
+        return self.records[key]
+
+
+def _process_record(task, writer: BackgroundWriter = None): # -> tuple[str, str, str]: (needs >python3.9)
+    kind, p, dest = task
+    os.makedirs(dest, exist_ok=True)
+    if kind == "author":
+        return process_author_metadata(p, dest, writer)
+    return process_book_metadata(p, dest, writer)
+
+
+def destination_folders(fp: str, output: str): # -> tuple[str, str]: (needs >python3.9)
     book_path = os.path.dirname(fp)
     auth_path = os.path.dirname(book_path)
-    base = os.path.basename(fp)
     auth_base = os.path.basename(auth_path)
 
     auth_dest = os.path.join(output, auth_base)
     book_dest = os.path.join(output, auth_base, os.path.basename(book_path))
+    return (auth_dest, book_dest)
+
+
+def determine_folder_structure_for_file(fp: str, output: str): # -> tuple[str, str]: (needs >python3.9)
+    base = os.path.basename(fp)
+    auth_dest, book_dest = destination_folders(fp, output)
 
     logger.info(f"Determining directory structure for: {base}")
     if not os.path.isdir(auth_dest):
         try:
-            os.mkdir(auth_dest)
+            os.makedirs(auth_dest, exist_ok=True)
         except Exception:
             msg = f"Could not create directory {auth_dest}"
             logger.critical(msg)
@@ -113,7 +172,7 @@ def determine_folder_structure_for_file(fp: str, output: str): # -> tuple[str, s
 
     if not os.path.isdir(book_dest):
         try:
-            os.mkdir(book_dest)
+            os.makedirs(book_dest, exist_ok=True)
         except Exception:
             msg = f"Could not create directory {book_dest}"
             logger.critical(msg)
@@ -122,8 +181,287 @@ def determine_folder_structure_for_file(fp: str, output: str): # -> tuple[str, s
     return (auth_dest, book_dest)
 
 
-def convert_corpus(p: str, output="tei"):
-    """Given an OpenITI Corpus folder, process the books contained."""
+class FileResult(TypedDict):
+    site: Optional[Dict]
+    outputs: List[str]
+    converted: bool
+    profile: Optional[Dict]
+    # Whether the TEI came from the result cache, None without one.
+    cached: Optional[bool]
+
+
+def locate_metadata(mdf: str): # -> tuple[str, str, Optional[str]]: (needs >python3.9)
+    """Find the author, book and version YAML files of a mARkdown file."""
+    from openiti.helper.funcs import get_all_yml_files_in_folder
+    book_path = os.path.dirname(mdf)
+    auth_path = os.path.dirname(book_path)
+
+    yauth_path = next(get_all_yml_files_in_folder(auth_path, "author"))
+    ybook_path = next(get_all_yml_files_in_folder(book_path, "book"))
+
+    # Choose the right file since there could be multiple versions and md files in book
+    yvers_paths = get_all_yml_files_in_folder(book_path, "version")
+    yvers_path = [yp for yp in yvers_paths if os.path.basename(yp) == version_yml_name(mdf)]
+
+    return (yauth_path, ybook_path, yvers_path[0] if len(yvers_path) > 0 else None)
+
+
+def convert_file(mdf: str, output: str, stream=False, records: MetadataCache = None, profile=False,
+                 parse_cache: ParseCache = None, shard_size: int = None, book_jobs=1, text: str = None,
+                 writer: BackgroundWriter = None, located=None, result_cache: ResultCache = None) -> FileResult:
+    """Convert one mARkdown file of the corpus and write out its metadata records,
+    unless they are already in records.
+    Returns the file's sitemap entry (None when the file had to be skipped) and the files written,
+    and with profile=True the conversion's timings and counters (see oitei.profiling).
+    With book_jobs > 1, a large book is converted by that many processes (see Converter.convert).
+    text is the content of mdf, when it was already read. With a writer, the TEI file is
+    written out in the background, except when streamed or sharded.
+    A streamed or sharded book is read and parsed in chunks, unless its text was given or
+    a parse_cache is used (see Converter.from_file).
+    located are the author, book and version YAML files of mdf, when they were already looked up
+    (see CorpusIndex); a missing version file was then already reported.
+    With a result_cache, a TEI file converted before is copied out of it rather than converted
+    again, unless the book is sharded."""
+    if records is None:
+        records = MetadataCache()
+    filename = os.path.basename(mdf)
+
+    # Determine folder structure: creates structure if needed
+    auth_dest, book_dest = determine_folder_structure_for_file(mdf, output)
+
+    if located is None:
+        yauth_path, ybook_path, yvers_path = locate_metadata(mdf)
+        if not yvers_path:
+            logger.error(f"Could not locate version metadata file for: {mdf}")
+    else:
+        yauth_path, ybook_path, yvers_path = located
+
+    # Process author metadata
+    auth_uri, author, xauth_path = records.author(yauth_path, auth_dest)
+
+    # Process book metadata
+    book_uri, book, xbook_path = records.book(ybook_path, book_dest)     
+
+    result: FileResult = {
+        "site": None,
+        "outputs": [xauth_path, xbook_path],
+        "converted": False,
+        "profile": None,
+        "cached": None
+    }
+
+    # Process version metadata 
+    if yvers_path:
+        yvers = readYML(yvers_path, reflow=True)
+        version_record = make_version_record(yvers)
+    else:
+        return result
+
+    # Sitemap entry
+    result["site"] = {
+        "auth_uri": auth_uri,
+        "author": author,
+        "book_uri": book_uri,
+        "book": book,
+        "file_info": {
+            "title": book,
+            "version": version_record["uri"],
+            "filename": filename,
+            "url": f"https://raw.githubusercontent.com/OpenITI/0575AH/tei/data/{auth_uri}/{book_uri}/{filename}.xml"
+        }
+    }
+
+    # Assemble metadata
+    metadata: Metadata = {
+        "prefix": "oitei",
+        "auth_uri": auth_uri,
+        "author": author,
+        "book_uri": book_uri,
+        "book": book,
+        "idno": version_record["uri"]
+    }
+
+    # A book written out as it gets converted is also read and parsed a chunk at a time.
+    chunked = (stream or shard_size) and text is None and parse_cache is None
+    if text is None and not chunked:
+        with open(mdf) as file:
+            text = file.read()
+
+    tei_path = os.path.join(book_dest, f"{filename}.xml")
+    key = None
+    if result_cache is not None and not shard_size:
+        # Besides the text and metadata, the TEI has the version record and links to the metadata files.
+        depends = {"version": yvers, "links": [os.path.basename(xauth_path), os.path.basename(xbook_path)]}
+        if text is None:
+            key = result_cache.file_key(mdf, metadata, depends)
+        else:
+            key = result_cache.key(text, metadata, depends)
+        if result_cache.copy_to(key, tei_path):
+            result["outputs"].append(tei_path)
+            result["converted"] = True
+            result["cached"] = True
+            logger.info(f"Converted {mdf} (from the result cache)")
+            return result
+        result["cached"] = False
+
+    try:
+        if chunked:
+            C = Converter.from_file(mdf, metadata, profile)
+        else:
+            C = Converter(cleanup_nbsp(text), metadata, profile, parse_cache=parse_cache)
+        if stream or shard_size:
+            # The header must be complete before the body gets written out.
+            C.convert_header()
+        else:
+            C.convert(book_jobs)
+        C.doc = add_version_record_to_tei(version_record, C.doc)
+        C.doc = link_metadata(os.path.basename(xauth_path), os.path.basename(xbook_path), C.doc)
+
+        # Write out
+        if shard_size:
+            result["outputs"].extend(C.write_shards(tei_path, shard_size))
+        elif stream or writer is None:
+            # Once converted, the document is written out as it gets serialized.
+            C.write_to(tei_path)
+            if key is not None:
+                _cache_result(result_cache.store_file, key, tei_path)
+        else:
+            data = C.tobytes()
+            writer.write(tei_path, data)
+            if key is not None:
+                _cache_result(result_cache.store, key, data)
+
+        result["outputs"].append(tei_path)
+        result["converted"] = True
+        if profile:
+            result["profile"] = C.profile.as_dict()
+        logger.info(f"Converted {mdf}")
+    except:
+        logger.error(f"Error while processing mARkdown file {mdf}")
+        logger.error(traceback.format_exc())
+
+    return result
+
+
+def _cache_result(store, key: str, data):
+    # The conversion succeeded all the same.
+    try:
+        store(key, data)
+    except OSError:
+        logger.warning(f"Could not write result cache entry {key}")
+        logger.warning(traceback.format_exc())
+
+
+class _RecordCollector(logging.Handler):
+    """Keeps the log records of a worker process so they can be replayed, in order, by the parent."""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Make the record safe to pickle.
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+_collector = None
+
+
+def _init_worker():
+    global _collector
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    _collector = _RecordCollector()
+    root.addHandler(_collector)
+
+
+def _run_in_worker(fn, arg):
+    _collector.records = []
+    result = fn(arg)
+    return (result, _collector.records)
+
+
+def _replay(records):
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+
+
+def _convert_with_records(convert, job):
+    mdf, records, located = job
+    return convert(mdf, records=MetadataCache(records), located=located)
+
+
+def _convert_files(mdfiles: List[str], index: CorpusIndex, output: str, stream: bool, jobs: int, profile=False,
+                   parse_cache: ParseCache = None, shard_size: int = None, book_jobs=1,
+                   writer: BackgroundWriter = None, result_cache: ResultCache = None):
+    """Yield (path, result) for each file, in order. Their YAML files are looked up in index.
+    With a writer, a single process reads the next files ahead and writes out in the background."""
+    convert = partial(convert_file, output=output, stream=stream, profile=profile, parse_cache=parse_cache,
+                      shard_size=shard_size, book_jobs=book_jobs, result_cache=result_cache)
+    records = MetadataCache(writer=writer)
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as pool:
+            # First process every author and book record once, then convert the files,
+            # handing each one only the records it needs.
+            keys = {}
+            tasks = {}
+            for mdf in mdfiles:
+                auth_dest, book_dest = destination_folders(mdf, output)
+                yauth_path, ybook_path, _ = index.locate(mdf)
+                auth_key = MetadataCache.key("author", yauth_path)
+                book_key = MetadataCache.key("book", ybook_path)
+                tasks.setdefault(auth_key, ("author", yauth_path, auth_dest))
+                tasks.setdefault(book_key, ("book", ybook_path, book_dest))
+                keys[mdf] = (auth_key, book_key)
+            results = pool.map(partial(_run_in_worker, _process_record), tasks.values())
+            for key, (result, logs) in zip(tasks, results):
+                _replay(logs)
+                records.records[key] = result
+
+            # Results come back in submission order: logs and sitemap end up as in a serial run.
+            file_jobs = [(mdf, {k: records.records[k] for k in keys[mdf]}, index.locate(mdf)) for mdf in mdfiles]
+            results = pool.map(partial(_run_in_worker, partial(_convert_with_records, convert)), file_jobs)
+            for mdf, (result, logs) in zip(mdfiles, results):
+                _replay(logs)
+                yield (mdf, result)
+    else:
+        texts = prefetch(mdfiles) if writer is not None else repeat(None)
+        for mdf, text in zip(mdfiles, texts):
+            yield (mdf, convert(mdf, records=records, text=text, writer=writer, located=index.locate(mdf)))
+
+
+def convert_corpus(p: str, output="tei", stream=False, jobs=1, incremental=False, profile=False,
+                   parse_cache: str = None, shard_size: int = None, book_jobs=1, pipeline=False,
+                   result_cache: str = None, result_cache_size: int = None):
+    """Given an OpenITI Corpus folder, process the books contained.
+    With stream=True, each TEI file is written out while it is being converted.
+    With jobs > 1, files are converted by a pool of that many processes.
+    With incremental=True, a manifest of source hashes is kept in the output folder and
+    a new run only converts again the files whose mARkdown or YAML sources have changed.
+    With profile=True, the timings and counters of each converted file and their totals
+    are written to oitei-profile.json in the output folder.
+    With a parse_cache folder, parsed mARkdown documents are kept there and reused by
+    later runs over the same texts (see oitei.ParseCache).
+    With a shard_size (in bytes), the body of each TEI file is split into shard files of
+    about that size, included by the main file with xi:include (see Converter.write_shards).
+    The sitemap is returned, and written to oitei-sitemap.jsonl in the output folder as files
+    are converted, so that the site can be made later on (see load_sitemap).
+    With book_jobs > 1, each large book is split at its top-level sections, which are converted
+    by that many processes: this helps runs whose time goes to a few huge books.
+    It does not apply to streamed or sharded output.
+    With pipeline=True and a single process, upcoming mARkdown files are read while the current one
+    is converted, and the TEI and metadata files are written out by background threads, with at most
+    oitei.corpus.pipeline.WRITE_BUFFER bytes waiting at once.
+    Files without author, book or version metadata are reported before the conversion starts;
+    those without author or book metadata are skipped.
+    With a result_cache folder, converted TEI files are kept there and copied out by later runs
+    over the same texts and metadata, instead of being converted again; with a result_cache_size
+    (in bytes), the least recently used ones are removed once the cache gets larger
+    (see oitei.ResultCache). The hits and misses of the run are logged."""
     # Structure:
     # > data
     # > > author+
@@ -139,115 +477,119 @@ def convert_corpus(p: str, output="tei"):
     # * create folder structure
     # * create metadata files
     # * convert
-
+    setup_logging()
     if not os.path.exists(p):
         sys.exit("Path to corpus does not exist.")
+    manifest = None
     if not os.path.exists(output):
         try:
             os.mkdir(output)
         except Exception:
             raise Exception("Could not create output directory.")
     elif len(os.listdir(output)) > 0:
-        sys.exit("Output directory is not empty.")
-
-    mdfiles = get_all_text_files_in_folder(p)
-
-    # Keep track of data needed for sitemap
-    sitemap = {
-        "group": os.path.split(p)[-1],
-        "authors": []
-    }
-
+        if incremental:
+            manifest = load_manifest(output)
+        if manifest is None:
+            sys.exit("Output directory is not empty.")
+
+    # Find all files in one walk of the corpus, and report missing metadata before converting anything.
+    # Files without author or book metadata cannot be converted.
+    index = CorpusIndex(p)
+    skipped = set()
+    for mdf, kinds in index.missing().items():
+        logger.error(f"Could not locate {' and '.join(kinds)} metadata file for: {mdf}")
+        if "author" in kinds or "book" in kinds:
+            skipped.add(mdf)
+    mdfiles = [mdf for mdf in index.texts if mdf not in skipped]
+
+    # Skip files that have not changed since the last run, unless their outputs are laid out differently.
+    options = {"stream": bool(stream), "shard_size": shard_size}
+    previous = reusable_files(manifest, __version__, options)
+    entries = {}
+    inputs = {}
+    todo = []
     for mdf in mdfiles:
-        filename = os.path.basename(mdf)
-        book_path = os.path.dirname(mdf)
-        auth_path = os.path.dirname(book_path)
-
-        # Determine folder structure: creates structure if needed
-        auth_dest, book_dest = determine_folder_structure_for_file(mdf, output)
-
-        # Process author metadata
-        yauth_path = next(get_all_yml_files_in_folder(auth_path, "author"))
-        auth_uri, author, xauth_path = process_author_metadata(yauth_path, auth_dest)
-
-        # Process book metadata (choose the right book)
-        ybook_path = next(get_all_yml_files_in_folder(book_path, "book"))
-        book_uri, book, xbook_path = process_book_metadata(ybook_path, book_dest)     
-
-        # Process version metadata 
-        # Choose the right file since there could be multiple versions and md files in book
-        yvers_paths = get_all_yml_files_in_folder(book_path, "version")
-        cleanfn = filename.replace(".inProgress", "").replace(".completed", "").replace(".mARkdown", "")
-        yvers_path = [yp for yp in yvers_paths if os.path.basename(yp) == cleanfn + ".yml"]
-        if len(yvers_path) > 0:
-            yvers = readYML(yvers_path[0], reflow=True)
-            version_record = make_version_record(yvers)
-        else:
-            logger.error(f"Could not locate version metadata file for: {mdf}")
-
-        # Add to sitemap
-        file_info = {
-            "title": book,
-            "version": version_record["uri"],
-            "filename": filename,
-            "url": f"https://raw.githubusercontent.com/OpenITI/0575AH/tei/data/{auth_uri}/{book_uri}/{filename}.xml"
-        }
-        book_info = {
-            "title": book,
-            "id": book_uri,
-            "files": [file_info]
-        }
-
-        site_auth = [a for a in sitemap["authors"] if a["id"] == auth_uri]
-        if not site_auth:
-            site_auth = {
-                "id": auth_uri,
-                "name": author,
-                "books": [book_info]
-            }
-            sitemap["authors"].append(site_auth)
-        else:
-            site_book = [b for b in site_auth[0]["books"] if b["id"] == book_uri]
-            if not site_book:
-                site_auth[0]["books"].append(book_info)
+        if incremental:
+            key = os.path.relpath(mdf, p)
+            inputs[key] = hash_inputs([mdf] + [y for y in index.locate(mdf) if y], p)
+            if is_up_to_date(previous.get(key), inputs[key], output):
+                logger.info(f"Unchanged: {mdf}")
+                entries[key] = previous[key]
+                continue
+        todo.append(mdf)
+
+    cache = ParseCache(parse_cache) if parse_cache else None
+    results_cache = ResultCache(result_cache, result_cache_size) if result_cache else None
+    # Only a run in a single process is pipelined.
+    writer = BackgroundWriter() if pipeline and jobs <= 1 else None
+    converted = _convert_files(todo, index, output, stream, jobs, profile, cache, shard_size, book_jobs, writer,
+                               results_cache)
+    results = {}
+
+    # Keep track of data needed for sitemap, in the order of the files.
+    with open(os.path.join(output, SITEMAP), "w", encoding="utf-8") as sitemap_file:
+        sitemap = Sitemap(os.path.split(p)[-1], sitemap_file)
+        for mdf in mdfiles:
+            key = os.path.relpath(mdf, p)
+            if key in entries:
+                site_info = entries[key]["site"]
             else:
-                site_book[0]["files"].append(file_info)
-
-
-        # Assemble metadata
-        metadata: Metadata = {
-            "prefix": "oitei",
-            "auth_uri": auth_uri,
-            "author": author,
-            "book_uri": book_uri,
-            "book": book,
-            "idno": version_record["uri"]
-        }
-
-        with open(mdf) as file:
-            text = file.read()
-            try:
-                C = Converter(cleanup_nbsp(text), metadata)
-                C.convert()
-                C.doc = add_version_record_to_tei(version_record, C.doc)
-                C.doc = link_metadata(os.path.basename(xauth_path), os.path.basename(xbook_path), C.doc)
-
-                # Write out
-                with open(os.path.join(book_dest, f"{filename}.xml"), "w") as writer:
-                    writer.write(C.tostring())
-                
-                logger.info(f"Converted {mdf}")
-            except:
-                logger.error(f"Error while processing mARkdown file {mdf}")
-                logger.error(traceback.format_exc())
+                # Files to convert come out in the same order.
+                _, result = next(converted)
+                results[mdf] = result
+                if incremental:
+                    entries[key] = {
+                        "inputs": inputs[key],
+                        "outputs": [os.path.relpath(o, output) for o in result["outputs"]],
+                        "site": result["site"],
+                        "converted": result["converted"]
+                    }
+                site_info = result["site"]
+            if site_info:
+                sitemap.add(**site_info)
+    # Every file was yielded: let the workers shut down.
+    converted.close()
+    if writer is not None:
+        # Files whose output could not be written out are converted again by the next incremental run.
+        failed = writer.close()
+        for mdf, result in results.items():
+            if failed.intersection(result["outputs"]):
+                result["converted"] = False
+                key = os.path.relpath(mdf, p)
+                if key in entries:
+                    entries[key]["converted"] = False
+
+    if incremental:
+        if manifest is not None:
+            remove_stale_outputs(output, manifest["files"], entries)
+        save_manifest(output, __version__, entries, options)
+
+    if results_cache is not None:
+        # Counted from the results: files may have been converted by other processes.
+        looked_up = [r["cached"] for r in results.values() if r["cached"] is not None]
+        stats = results_cache.stats()
+        logger.info(f"Result cache: {sum(looked_up)} hits, {len(looked_up) - sum(looked_up)} misses, "
+                    f"{stats['entries']} entries, {stats['size']} bytes")
+
+    if profile:
+        profiles = {os.path.relpath(mdf, p): r["profile"] for mdf, r in results.items() if r["profile"]}
+        total = aggregate(profiles.values())
+        with open(os.path.join(output, PROFILE), "w") as f:
+            json.dump({"total": total, "files": profiles}, f, indent=1)
+        phases = ", ".join(f"{name} {times['wall']:.2f}s" for name, times in total["phases"].items())
+        logger.info(f"Profiled {total['files']} files: {phases}")
 
     # make TEI site from template
     # try:
-    #     makesite_local("/home/rviglian/Projects/openiti-teicorpus-site-template", sitemap, output=output, copy=True)
+    #     makesite_local("/home/rviglian/Projects/openiti-teicorpus-site-template", sitemap.as_dict(), output=output, copy=True)
     #     logger.info("Created TEI website.")
     # except:
     #     logger.error(f"Error while creating TEI site for {p}.")
     #     logger.error(traceback.format_exc())
             
     # Copy log once done.
-    shutil.copyfile(LOGFILEPATH, os.path.join(output, LOGFILE))
+    # (There is none when logging was configured before the first run.)
+    if os.path.exists(LOGFILEPATH):
+        shutil.copyfile(LOGFILEPATH, os.path.join(output, LOGFILE))
+
+    return sitemap.as_dict()
@@ -0,0 +1,51 @@
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Separates the fields of a YAML key, e.g. "10#AUTH#KUNYA##AR:" -> ["10", "AUTH", "KUNYA", "AR:"]
+FIELD_SEP = re.compile("#+")
+STARTS_WITH_DIGIT = re.compile(r"\d")
+# Distinct keys remembered by a FieldMapper. Records share a handful of keys, this only bounds
+# the memory used by malformed ones.
+MAX_KEYS = 10000
+
+# Called with the record being built, the fields of the key, its value and the key itself.
+Handler = Callable[[object, List[str], str, str], None]
+
+
+def safe_id(uri: str) -> str:
+    """Make a URI usable as an xml:id, which cannot start with a digit."""
+    uri = uri.strip()
+    if STARTS_WITH_DIGIT.match(uri):
+        return f"oitei_{uri}"
+    return uri
+
+
+class FieldMapper:
+    """Maps the keys of an OpenITI YAML record to the handlers that convert their values.
+    rules are (pattern, handler) pairs: the first pattern matching the start of a key gives its handler.
+    All records of a kind share the same keys, so each key is matched and split only once."""
+    def __init__(self, rules): # rules: list[tuple[str, Handler]] (needs >python3.9)
+        self.rules = [(re.compile(pattern), handler) for pattern, handler in rules]
+        self._keys: Dict[str, Optional[Tuple[Handler, List[str]]]] = {}
+
+    def lookup(self, entry: str): # -> Optional[tuple[Handler, list[str]]]: (needs >python3.9)
+        try:
+            return self._keys[entry]
+        except KeyError:
+            pass
+        found = None
+        for pattern, handler in self.rules:
+            if pattern.match(entry):
+                found = (handler, FIELD_SEP.split(entry))
+                break
+        if len(self._keys) < MAX_KEYS:
+            self._keys[entry] = found
+        return found
+
+    def apply(self, yml: Dict, rec):
+        for entry, value in yml.items():
+            found = self.lookup(entry)
+            if found is not None:
+                handler, fields = found
+                handler(rec, fields, value, entry)
+        return rec
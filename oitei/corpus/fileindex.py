@@ -0,0 +1,96 @@
+import os
+import re
+from typing import Dict, List, Tuple
+
+# Same rules as openiti.helper.funcs: text files have a language identifier (-ara1, -per1...)
+# and no extension, or .inProgress, .completed or .mARkdown.
+TEXT_FILE = re.compile(r"-(?:\w\w\w\d)+(?:.inProgress|.completed|.mARkdown)?\Z")
+# Author, book and version YAML files have one, two and three parts before .yml.
+YML_FILE = re.compile(r"(?:[^.]+\.){1,3}yml\Z")
+YML_KINDS = {1: "author", 2: "book", 3: "version"}
+
+
+def version_yml_name(mdf: str) -> str:
+    """The file name of the version YAML file of a mARkdown file."""
+    filename = os.path.basename(mdf)
+    cleanfn = filename.replace(".inProgress", "").replace(".completed", "").replace(".mARkdown", "")
+    return cleanfn + ".yml"
+
+
+class CorpusIndex:
+    """The mARkdown and YAML files of a corpus, found in a single walk of its folder.
+    Finds the same files as openiti.helper.funcs and locate_metadata, in the same order, without
+    walking the author and book folders again for each mARkdown file. Folders above the corpus
+    folder (e.g. the author folder when given a book folder) are walked when first looked up."""
+    def __init__(self, root: str):
+        from openiti.helper.funcs import exclude_folders, exclude_files
+        self.root = root
+        self.texts: List[str] = []
+        # Folder -> first YAML file of the kind found in it or its subfolders
+        self.authors: Dict[str, str] = {}
+        self.books: Dict[str, str] = {}
+        # (folder, file name) -> version YAML file in it or its subfolders
+        self.versions: Dict[Tuple[str, str], str] = {}
+        self._walked = set()
+        self._exclude_folders = set(exclude_folders)
+        self._exclude_files = set(exclude_files)
+        self._walk(root, [])
+
+    def _walk(self, folder: str, parents: List[str]):
+        # Files of a folder come before those of its subfolders, as with os.walk.
+        try:
+            with os.scandir(folder) as it:
+                entries = list(it)
+        except OSError:
+            return
+        self._walked.add(folder)
+        folders = parents + [folder]
+        subfolders = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if entry.name not in self._exclude_folders and not entry.is_symlink():
+                    subfolders.append(entry.path)
+            elif entry.name not in self._exclude_files:
+                self._add(entry.name, entry.path, folders)
+        for subfolder in subfolders:
+            self._walk(subfolder, folders)
+
+    def _add(self, name: str, path: str, folders: List[str]):
+        if TEXT_FILE.search(name):
+            self.texts.append(path)
+        elif YML_FILE.match(name):
+            kind = YML_KINDS[name.count(".")]
+            for folder in folders:
+                if kind == "author":
+                    self.authors.setdefault(folder, path)
+                elif kind == "book":
+                    self.books.setdefault(folder, path)
+                else:
+                    self.versions.setdefault((folder, name), path)
+
+    def locate(self, mdf: str): # -> tuple[Optional[str], Optional[str], Optional[str]]: (needs >python3.9)
+        """The author, book and version YAML files of a mARkdown file, or None for those missing."""
+        book_path = os.path.dirname(mdf)
+        auth_path = os.path.dirname(book_path)
+        return (self._lookup(self.authors, "author", auth_path), self._lookup(self.books, "book", book_path),
+                self.versions.get((book_path, version_yml_name(mdf))))
+
+    def _lookup(self, table: Dict[str, str], kind: str, folder: str):
+        if folder not in table and folder not in self._walked:
+            from openiti.helper.funcs import get_all_yml_files_in_folder
+            table[folder] = next(get_all_yml_files_in_folder(folder, kind), None)
+        return table.get(folder)
+
+    def missing(self) -> Dict[str, List[str]]:
+        """The kinds of metadata ("author", "book", "version") missing for each mARkdown file
+        that lacks some."""
+        missing = {}
+        for mdf in self.texts:
+            kinds = [kind for kind, yml in zip(("author", "book", "version"), self.locate(mdf)) if yml is None]
+            if kinds:
+                missing[mdf] = kinds
+        return missing
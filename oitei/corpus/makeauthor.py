@@ -4,140 +4,140 @@ from typing import Dict
 from lxml.etree import Element
 from lxml import etree
 
-from oitei.tei_template import DECLS
-from oitei.namespaces import NS, XMLNS
+from oitei.tei_template import DECLS_BYTES
+from oitei.namespaces import XMLNS
+from .fieldmap import FieldMapper, safe_id
 
 logger = logging.getLogger(__name__)
 
-def make_author_record(yml: Dict) -> Element:
-    listPerson_el = etree.fromstring('<listPerson xmlns="http://www.tei-c.org/ns/1.0"/>')
-    person_el = etree.SubElement(listPerson_el, "person")
-    listRelation_el = etree.SubElement(listPerson_el, "listRelation")
-
-    author_id: str
-
-    def _get_event_el(ev_type):
-        tag = "birth"
-        if ev_type == "DIED":
-            tag = "death"
-        ev_el = person_el.find(f".//{tag}", NS)
+class _AuthorRecord:
+    """The author record being built, with the elements that later fields add to."""
+    def __init__(self):
+        self.listPerson_el = etree.fromstring('<listPerson xmlns="http://www.tei-c.org/ns/1.0"/>')
+        self.person_el = etree.SubElement(self.listPerson_el, "person")
+        self.listRelation_el = etree.SubElement(self.listPerson_el, "listRelation")
+        self.persname_el = None
+        self.events = {}
+        self.author_id = None
+
+    def event_el(self, ev_type: str) -> Element:
+        tag = "death" if ev_type == "DIED" else "birth"
+        ev_el = self.events.get(tag)
         if ev_el is None:
-            ev_el = etree.SubElement(person_el, tag)
+            ev_el = self.events[tag] = etree.SubElement(self.person_el, tag)
         return ev_el
 
-    for entry in yml:
-        value = yml[entry]
-        # URI / AUTHOR ID
-        if entry.startswith("00#AUTH#URI#"):
-            uri = value.strip()
-            safeid: str
-            if (re.match(r"^\d", uri)):
-                safeid = f"oitei_{uri}"
-            else:
-                safeid = uri
-            author_id = safeid
-
-        # NAMES
-        elif entry.startswith("10#AUTH#"):
-            # Find or create persName
-            persname_el = person_el.find(".//persName", NS)
-            if persname_el is None:
-                persname_el = etree.SubElement(person_el, "persName")
-
-            # Parse entry
-            [code, a, ntype, nlang] = re.split("#+", entry)
-            att = "type"
-            if ntype == "KUNYA":
-                att = "role"
-            name_el = etree.SubElement(persname_el, "name")
-            name_el.set(att, ntype.lower())
-            name_el.set(f"{XMLNS}lang", nlang.lower())
-            name_el.text = value.strip()
-
-        # BIRTH and DEATH
-        elif re.match(r"20#AUTH#(BORN|DIED)#", entry):
-            [code, a, event, lang] = re.split("#+", entry)
-            places = value.split(",")
-
-            ev_el = _get_event_el(event)
-            for place in places:
-                place_el = etree.SubElement(ev_el, "placeName")
-                place_el.set("ref", place.strip())
-
-        elif re.match(r"30#AUTH#(BORN|DIED)#", entry):
-            [code, a, event, cal] = re.split("#+", entry)
-            # Skip unknown date
-            if re.match(value, 'X+'):
-                continue
-            if cal[:-1] != "AH":
-                logger.warn(f"Unknown calendar in author record entry: {entry}")
-            
-            ev_el = _get_event_el(event)
-            ev_el.set("calendar", f"#{cal.lower()}")
-            ev_el.set("when-custom", value.strip())            
-
-        # PLACES VISITED
-        elif entry.startswith("20#AUTH#VISITED#"):
-            uris = value.strip().split(", ")
-            if len(uris) > 0:
-                el = etree.SubElement(person_el, "listEvent")
-                for u in uris:
-                    ev_el = etree.SubElement(el, "event")
-                    ev_el.set("type", "visit")
-                    ev_el.set("where", u.strip())
-                    etree.SubElement(ev_el, "p")
-
-        # RESIDENCES
-        elif entry.startswith("20#AUTH#RESIDED#"):
-            uris = value.strip().split(", ")
-            if len(uris) > 0:
-                for u in uris:
-                    res_el = etree.SubElement(person_el, "residence")
-                    place_el = etree.SubElement(res_el, "placeName")
-                    place_el.set("ref", u.strip())
-
-        # BIBLIOGRAPHY
-        elif entry.startswith("80#AUTH#BIBLIO#"):
-            uris = value.strip().split(", ")
-            if len(uris) > 0:
-                el = etree.SubElement(person_el, "listBibl")
-                for u in uris:
-                    b_el = etree.SubElement(el, "bibl")
-                    ptr_el = etree.SubElement(b_el, "ptr")
-                    ptr_el.set("target", u.strip())
-
-        # COMMENT 
-        elif entry.startswith("90#AUTH#COMMENT#"):
-            etree.SubElement(person_el, "note").text = value.strip()
-        
-        # RELATIONS
-        elif re.match(r"40#AUTH#(STUDENTS|TEACHERS)#", entry):
-            [code, a, role, rest] = re.split("#+", entry)
-            uris = value.strip().split(", ")
-            if len(uris) > 0:
-                for u in uris:
-                    relation_el = etree.SubElement(listRelation_el, "relation")
-                    relation_el.set("name", role.lower())
-                    active: str
-                    passive: str
-                    if role == "STUDENTS":
-                        active = f"#{author_id}"
-                        passive = u
-                    elif role == "TEACHERS":
-                        active = u
-                        passive = f"#{author_id}"
-                    else:
-                        logger.warn(f"Unknown relationship role: {role}")
-
-                    relation_el.set("active", active)
-                    relation_el.set("passive", passive)
-
-    person_el.set(f"{XMLNS}id", author_id)
-
-    return listPerson_el
+
+# URI / AUTHOR ID
+def _uri(rec: _AuthorRecord, fields, value: str, entry: str):
+    rec.author_id = safe_id(value)
+
+
+# NAMES
+def _name(rec: _AuthorRecord, fields, value: str, entry: str):
+    if rec.persname_el is None:
+        rec.persname_el = etree.SubElement(rec.person_el, "persName")
+    [code, a, ntype, nlang] = fields
+    att = "type"
+    if ntype == "KUNYA":
+        att = "role"
+    name_el = etree.SubElement(rec.persname_el, "name")
+    name_el.set(att, ntype.lower())
+    name_el.set(f"{XMLNS}lang", nlang.lower())
+    name_el.text = value.strip()
+
+
+# BIRTH and DEATH
+def _event_place(rec: _AuthorRecord, fields, value: str, entry: str):
+    [code, a, event, lang] = fields
+    ev_el = rec.event_el(event)
+    for place in value.split(","):
+        place_el = etree.SubElement(ev_el, "placeName")
+        place_el.set("ref", place.strip())
+
+
+def _event_date(rec: _AuthorRecord, fields, value: str, entry: str):
+    [code, a, event, cal] = fields
+    # Skip unknown date
+    if re.match(value, 'X+'):
+        return
+    if cal[:-1] != "AH":
+        logger.warn(f"Unknown calendar in author record entry: {entry}")
+
+    ev_el = rec.event_el(event)
+    ev_el.set("calendar", f"#{cal.lower()}")
+    ev_el.set("when-custom", value.strip())
+
+
+# PLACES VISITED
+def _visited(rec: _AuthorRecord, fields, value: str, entry: str):
+    el = etree.SubElement(rec.person_el, "listEvent")
+    for u in value.strip().split(", "):
+        ev_el = etree.SubElement(el, "event")
+        ev_el.set("type", "visit")
+        ev_el.set("where", u.strip())
+        etree.SubElement(ev_el, "p")
+
+
+# RESIDENCES
+def _resided(rec: _AuthorRecord, fields, value: str, entry: str):
+    for u in value.strip().split(", "):
+        res_el = etree.SubElement(rec.person_el, "residence")
+        place_el = etree.SubElement(res_el, "placeName")
+        place_el.set("ref", u.strip())
+
+
+# BIBLIOGRAPHY
+def _biblio(rec: _AuthorRecord, fields, value: str, entry: str):
+    el = etree.SubElement(rec.person_el, "listBibl")
+    for u in value.strip().split(", "):
+        b_el = etree.SubElement(el, "bibl")
+        ptr_el = etree.SubElement(b_el, "ptr")
+        ptr_el.set("target", u.strip())
+
+
+# COMMENT
+def _comment(rec: _AuthorRecord, fields, value: str, entry: str):
+    etree.SubElement(rec.person_el, "note").text = value.strip()
+
+
+# RELATIONS
+def _relation(rec: _AuthorRecord, fields, value: str, entry: str):
+    [code, a, role, rest] = fields
+    for u in value.strip().split(", "):
+        relation_el = etree.SubElement(rec.listRelation_el, "relation")
+        relation_el.set("name", role.lower())
+        if role == "STUDENTS":
+            relation_el.set("active", f"#{rec.author_id}")
+            relation_el.set("passive", u)
+        else:
+            relation_el.set("active", u)
+            relation_el.set("passive", f"#{rec.author_id}")
+
+
+AUTHOR_FIELDS = FieldMapper([
+    ("00#AUTH#URI#", _uri),
+    ("10#AUTH#", _name),
+    (r"20#AUTH#(BORN|DIED)#", _event_place),
+    (r"30#AUTH#(BORN|DIED)#", _event_date),
+    ("20#AUTH#VISITED#", _visited),
+    ("20#AUTH#RESIDED#", _resided),
+    ("80#AUTH#BIBLIO#", _biblio),
+    ("90#AUTH#COMMENT#", _comment),
+    (r"40#AUTH#(STUDENTS|TEACHERS)#", _relation),
+])
+
+
+def make_author_record(yml: Dict) -> Element:
+    rec = AUTHOR_FIELDS.apply(yml, _AuthorRecord())
+    rec.person_el.set(f"{XMLNS}id", rec.author_id)
+    return rec.listPerson_el
 
 
 def make_author_record_str(yml: Dict) -> str:
+    return make_author_record_bytes(yml).decode("utf-8")
+
+
+def make_author_record_bytes(yml: Dict) -> bytes:
     el = make_author_record(yml)
-    tree_str = etree.tostring(el, xml_declaration=False, pretty_print=True, encoding="UTF-8").decode("utf-8")
-    return DECLS + tree_str
+    return DECLS_BYTES + etree.tostring(el, xml_declaration=False, pretty_print=True, encoding="UTF-8")
@@ -1,10 +1,46 @@
-import requests
 import tempfile
-import os
-import zipfile
 import shutil
-
-def makesite_local(tpl_path: str, sitemap, repo="https://raw.githubusercontent.com/raffazizzi/", output="tei", copy=False):
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+# requests and zipfile are only imported when needed, as requests is slow to import.
+
+class Template:
+  """ A tpl-*.html template, split once at its {placeholders}: rendering joins the literal
+      parts with the values given for the slots, which are not searched for placeholders again.
+      Only the given names are placeholders, other braces (e.g. in scripts) are left alone. """
+  def __init__(self, text: str, names):
+    pattern = "|".join(re.escape(name) for name in names)
+    # Literal parts at even positions, slot names at odd positions.
+    self.parts = re.split(r"\{(" + pattern + r")\}", text)
+
+  @classmethod
+  def load(cls, path: str, names):
+    with open(path) as tpl:
+      return cls(tpl.read(), names)
+
+  def render_into(self, out: list, **values):
+    for i, part in enumerate(self.parts):
+      if i % 2:
+        value = values[part]
+        if isinstance(value, list):
+          out.extend(value)
+        else:
+          out.append(value)
+      else:
+        out.append(part)
+    return out
+
+  def render(self, **values) -> str:
+    return "".join(self.render_into([], **values))
+
+def _write_page(dirname: str, html: str):
+  os.mkdir(dirname)
+  with open(os.path.join(dirname, "index.html"), "w") as index:
+    index.write(html)
+
+def makesite_local(tpl_path: str, sitemap, repo="https://raw.githubusercontent.com/raffazizzi/", output="tei", copy=False,
+                   threads=8):
   if copy:
     copy_dest = os.path.join(tempfile.gettempdir(), os.path.basename(tpl_path))
     if os.path.exists(copy_dest) and os.path.isdir(copy_dest):
@@ -14,71 +50,50 @@ def makesite_local(tpl_path: str, sitemap, repo="https://raw.githubusercontent.c
     tpl_path = copy_dest
 
   # Get templates
-  tpl_cetei_path = os.path.join(tpl_path, "assets/tpl-cetei.html")
-  tpl_cetei = ""
-  with open(tpl_cetei_path) as tpl:
-    tpl_cetei = tpl.read()
-
-  tpl_entry_path = os.path.join(tpl_path, "assets/tpl-toc-entry.html")
-  tpl_entry = ""
-  with open(tpl_entry_path) as tpl:
-    tpl_entry = tpl.read()
-
-  tpl_book_path = os.path.join(tpl_path, "assets/tpl-toc-book.html")
-  tpl_book = ""
-  with open(tpl_book_path) as tpl:
-    tpl_book = tpl.read()
-
-  tpl_auth_path = os.path.join(tpl_path, "assets/tpl-toc-auth.html")
-  tpl_auth = ""
-  with open(tpl_auth_path) as tpl:
-    tpl_auth = tpl.read()
-
-  # Make TOC
-  auth_content = ""
-  for auth in sitemap["authors"]:
-    auth_content += tpl_auth.replace(r"{auth}", auth["name"])
-
-    book_content = ""
-    for book in auth["books"]:
-      book_content += tpl_book.replace(r"{book}", book["title"])
-
-      entries = ""
-
-      for file in book["files"]:
-        filename = file["filename"]
-
-        # Add entry
-        repodir = sitemap["group"] + "/tei/" + auth["id"] + "/" + book["id"]
-        tei_url = f"{repo}/{repodir}/{filename}.xml"
-        md_url = "https://raw.githubusercontent.com/OpenITI/" + sitemap["group"] + "/master/data/" + auth["id"] + "/" + book["id"] + "/" + filename
-        entry = tpl_entry.replace(r"{filename}", filename)
-        entry = entry.replace(r"{title}", file["title"])
-        entry = entry.replace(r"{uri}", file["version"])
-        entry = entry.replace(r"{tei_url}", tei_url)
-        entry = entry.replace(r"{md_url}", md_url)
-        entries += entry
-
-        dirname = os.path.join(tpl_path, filename)
-        os.mkdir(dirname)
-        cetei = tpl_cetei.replace(r"{tei_filename}", tei_url)
-        cetei = cetei.replace(r"{title}", file["title"])
-        with open(os.path.join(dirname, "index.html"), "w") as index:
-            index.write(cetei)
-
-      book_content = book_content.replace(r"{entries}", entries)
-    auth_content = auth_content.replace(r"{books}", book_content)
+  tpl_cetei = Template.load(os.path.join(tpl_path, "assets/tpl-cetei.html"), ["tei_filename", "title"])
+  tpl_entry = Template.load(os.path.join(tpl_path, "assets/tpl-toc-entry.html"),
+                            ["filename", "title", "uri", "tei_url", "md_url"])
+  tpl_book = Template.load(os.path.join(tpl_path, "assets/tpl-toc-book.html"), ["book", "entries"])
+  tpl_auth = Template.load(os.path.join(tpl_path, "assets/tpl-toc-auth.html"), ["auth", "books"])
+
+  # Make TOC, while the page of each file is written out by the pool.
+  toc = []
+  with ThreadPoolExecutor(max_workers=threads) as pool:
+    pages = []
+    for auth in sitemap["authors"]:
+      books = []
+      for book in auth["books"]:
+        entries = []
+
+        for file in book["files"]:
+          filename = file["filename"]
+
+          # Add entry
+          repodir = sitemap["group"] + "/tei/" + auth["id"] + "/" + book["id"]
+          tei_url = f"{repo}/{repodir}/{filename}.xml"
+          md_url = "https://raw.githubusercontent.com/OpenITI/" + sitemap["group"] + "/master/data/" + auth["id"] + "/" + book["id"] + "/" + filename
+          tpl_entry.render_into(entries, filename=filename, title=file["title"], uri=file["version"],
+                                tei_url=tei_url, md_url=md_url)
+
+          cetei = tpl_cetei.render(tei_filename=tei_url, title=file["title"])
+          pages.append(pool.submit(_write_page, os.path.join(tpl_path, filename), cetei))
+
+        tpl_book.render_into(books, book=book["title"], entries=entries)
+      tpl_auth.render_into(toc, auth=auth["name"], books=books)
+    # Raise the first error, if any page could not be written.
+    for page in pages:
+      page.result()
 
   with open(os.path.join(tpl_path, "index.html"), "r") as index:
-    contents = index.read()
-    contents = contents.replace(r"{group}", sitemap["group"])
-    contents = contents.replace(r"{toc}", auth_content)
+    contents = Template(index.read(), ["group", "toc"]).render(group=sitemap["group"], toc=toc)
     with open(os.path.join(tpl_path, "index.html"), "w") as index_w:
       index_w.write(contents)
 
   return tpl_path
 
 def makesite(sitemap, url="https://github.com/OpenITI/openiti-teicorpus-site-template/archive/simple.zip", output="tei"):
+  import requests
+  import zipfile
   response = requests.get(url)
   tmp = tempfile.gettempdir()
   dest = os.path.join(tmp, "openiti-site-template.zip")
@@ -1,10 +1,10 @@
-import re
 from typing import Dict
 from typing import TypedDict
 from lxml import etree
 from lxml.etree import Element
 
 from oitei.tei_template import DECLS
+from .fieldmap import FieldMapper, safe_id
 
 class VersionRecord(TypedDict):
     uri: str
@@ -14,6 +14,57 @@ class VersionRecord(TypedDict):
     note: Element
     date: Element
 
+# URI
+def _uri(rec: VersionRecord, fields, value: str, entry: str):
+    rec["uri"] = safe_id(value)
+
+
+def _length(rec: VersionRecord, fields, value: str, entry: str):
+    measure_el = etree.SubElement(rec["extent"], "measure")
+    unit = "words"
+    if fields[2] == "CLENGTH":
+        unit = "characters"
+    measure_el.set("unit", unit)
+    measure_el.text = value.strip()
+
+
+def _based(rec: VersionRecord, fields, value: str, entry: str):
+    [code, v, btype, rest] = fields
+    for u in value.strip().split(", "):
+        bibl_el = etree.SubElement(rec["bibl"], "bibl")
+        bibl_el.set("type", btype.lower())
+        ptr_el = etree.SubElement(bibl_el, "ptr")
+        ptr_el.set("target", u.strip())
+
+
+def _annotator(rec: VersionRecord, fields, value: str, entry: str):
+    resp_el = etree.SubElement(rec["resp"], "resp")
+    resp_el.text = "Annotator"
+    name_el = etree.SubElement(rec["resp"], "name")
+    name_el.text = value.strip()
+
+
+def _comment(rec: VersionRecord, fields, value: str, entry: str):
+    p_el = etree.SubElement(rec["note"], "p")
+    p_el.text = value.strip()
+
+
+def _date(rec: VersionRecord, fields, value: str, entry: str):
+    change_el = etree.SubElement(rec["date"], "change")
+    change_el.set("when", value.strip())
+    change_el.text = "Latest change."
+
+
+VERSION_FIELDS = FieldMapper([
+    ("00#VERS#URI######", _uri),
+    ("00#VERS#C?LENGTH##", _length),
+    ("80#VERS#(BASED|COLLATED|LINKS)####", _based),
+    ("90#VERS#ANNOTATOR", _annotator),
+    ("90#VERS#COMMENT#", _comment),
+    ("90#VERS#DATE#####", _date),
+])
+
+
 def make_version_record(yml: Dict) -> VersionRecord:
     rec: VersionRecord = {
         "uri": "",
@@ -23,49 +74,7 @@ def make_version_record(yml: Dict) -> VersionRecord:
         "note": etree.fromstring('<encodingDesc xmlns="http://www.tei-c.org/ns/1.0"/>'),
         "date": etree.fromstring('<revisionDesc xmlns="http://www.tei-c.org/ns/1.0"/>')
     }
-
-    for entry in yml:
-        value = yml[entry]
-        # URI
-        if entry.startswith("00#VERS#URI######"):
-            uri = value.strip()
-            safeid: str
-            if (re.match(r"^\d", uri)):
-                safeid = f"oitei_{uri}"
-            else:
-                safeid = uri    
-            rec["uri"] = safeid
-        if re.match("00#VERS#C?LENGTH##", entry):
-            measure_el = etree.SubElement(rec["extent"], "measure")
-            unit = "words"
-            if "CLENGTH" in entry:
-                unit = "characters"
-            measure_el.set("unit", unit)
-            measure_el.text = value.strip()
-        if re.match("80#VERS#(BASED|COLLATED|LINKS)####", entry):
-            [code, v, btype, rest] = re.split("#+", entry)
-
-            uris = value.strip().split(", ")
-            if len(uris) > 0:
-                for u in uris:
-                    bibl_el = etree.SubElement(rec["bibl"], "bibl")
-                    bibl_el.set("type", btype.lower())
-                    ptr_el = etree.SubElement(bibl_el, "ptr")
-                    ptr_el.set("target", u.strip())
-        if entry.startswith("90#VERS#ANNOTATOR"):
-            resp_el = etree.SubElement(rec["resp"], "resp")
-            resp_el.text = "Annotator"
-            name_el = etree.SubElement(rec["resp"], "name")
-            name_el.text = value.strip()
-        elif entry.startswith("90#VERS#COMMENT#"):
-            p_el = etree.SubElement(rec["note"], "p")
-            p_el.text = value.strip()
-        elif entry.startswith("90#VERS#DATE#####"):
-            change_el = etree.SubElement(rec["date"], "change")
-            change_el.set("when", yml.get("90#VERS#DATE#####:").strip())
-            change_el.text = "Latest change."
-
-    return rec
+    return VERSION_FIELDS.apply(yml, rec)
 
 
 def make_version_record_str(yml: Dict) -> str:
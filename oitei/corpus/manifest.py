@@ -0,0 +1,68 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, List, Optional
+
+from oitei._atomic import write_atomic
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "oitei-manifest.json"
+
+
+def hash_file(p: str) -> str:
+    h = hashlib.sha256()
+    with open(p, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_inputs(paths: List[str], root: str) -> Dict[str, str]:
+    """Map each source file, relative to the corpus root, to the hash of its content."""
+    return {os.path.relpath(p, root): hash_file(p) for p in paths}
+
+
+def load_manifest(output: str) -> Optional[Dict]:
+    manifest_path = os.path.join(output, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(output: str, version: str, files: Dict, options: Dict = None):
+    """options are those of the run that change its outputs (e.g. how they are sharded)."""
+    manifest = {"oitei": version, "options": options or {}, "files": files}
+    write_atomic(os.path.join(output, MANIFEST), json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"))
+
+
+def reusable_files(manifest: Optional[Dict], version: str, options: Dict) -> Dict:
+    """The files of a previous manifest, if it was written by the same oitei version with the same options."""
+    if manifest is None or manifest["oitei"] != version or manifest.get("options", {}) != options:
+        return {}
+    return manifest["files"]
+
+
+def is_up_to_date(entry: Optional[Dict], inputs: Dict[str, str], output: str) -> bool:
+    """A file can be skipped if it was converted from the same inputs and its outputs are still there."""
+    if not entry or not entry["converted"] or entry["inputs"] != inputs:
+        return False
+    return all(os.path.exists(os.path.join(output, o)) for o in entry["outputs"])
+
+
+def remove_stale_outputs(output: str, previous: Dict, current: Dict):
+    """Delete the outputs recorded in the previous manifest that no current file produces anymore."""
+    keep = set(o for entry in current.values() for o in entry["outputs"])
+    stale = set(o for entry in previous.values() for o in entry["outputs"]) - keep
+    for o in sorted(stale):
+        stale_path = os.path.join(output, o)
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+            logger.info(f"Removed stale output {stale_path}")
+        # Remove the author and book folders once they are empty.
+        parent = os.path.dirname(stale_path)
+        while os.path.abspath(parent) != os.path.abspath(output) and os.path.isdir(parent) and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
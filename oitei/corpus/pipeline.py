@@ -0,0 +1,94 @@
+import logging
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Set, Union
+
+logger = logging.getLogger(__name__)
+
+# Input files read ahead of the conversion.
+PREFETCH = 2
+WRITE_THREADS = 4
+# Most output waiting to be written at once, in bytes (or characters).
+WRITE_BUFFER = 256 * 1024 * 1024
+
+
+def _read_file(p: str) -> str:
+    with open(p) as f:
+        return f.read()
+
+
+def _write_file(p: str, data: Union[str, bytes]):
+    with open(p, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+
+
+def prefetch(paths: Iterable[str], ahead=PREFETCH) -> Iterator[str]:
+    """Yield the text of each file in turn, while the next ones are read in background threads.
+    At most `ahead` files are read before they are asked for."""
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=ahead, thread_name_prefix="oitei-reader") as pool:
+        reads = deque()
+        for p in paths:
+            reads.append(pool.submit(_read_file, p))
+            if len(reads) == ahead:
+                break
+        while reads:
+            text = reads.popleft().result()
+            p = next(paths, None)
+            if p is not None:
+                reads.append(pool.submit(_read_file, p))
+            yield text
+
+
+class BackgroundWriter:
+    """Writes files from background threads, so that conversions do not wait for the disk.
+    write() blocks while more than max_pending bytes wait to be written: memory stays capped
+    however slow the disk is. close() waits for all writes and returns the paths that failed."""
+
+    def __init__(self, threads=WRITE_THREADS, max_pending=WRITE_BUFFER):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.failed = set()
+        self._room = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="oitei-writer")
+
+    def write(self, p: str, data: Union[str, bytes]):
+        size = len(data)
+        with self._room:
+            # Output larger than the buffer gets written on its own.
+            self._room.wait_for(lambda: self.pending == 0 or self.pending + size <= self.max_pending)
+            self.pending += size
+        self._pool.submit(self._write, p, data, size)
+
+    def _write(self, p: str, data: Union[str, bytes], size: int):
+        try:
+            _write_file(p, data)
+        except Exception:
+            logger.error(f"Could not write {p}")
+            logger.error(traceback.format_exc())
+            with self._room:
+                self.failed.add(p)
+        finally:
+            with self._room:
+                self.pending -= size
+                self._room.notify_all()
+
+    def close(self) -> Set[str]:
+        self._pool.shutdown(wait=True)
+        return self.failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_file(p: str, data: Union[str, bytes], writer: BackgroundWriter = None):
+    """Write data to p, through writer if given."""
+    if writer is not None:
+        writer.write(p, data)
+    else:
+        _write_file(p, data)
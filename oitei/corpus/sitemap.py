@@ -0,0 +1,75 @@
+import json
+from typing import Dict, IO
+
+SITEMAP = "oitei-sitemap.jsonl"
+
+
+class Sitemap:
+    """The authors, books and files of a corpus, as needed to make its site (see makesite).
+    Authors and books are indexed by URI, so that adding a file does not scan the sitemap.
+    With a writer, the group and then every file added are written out as lines of JSON,
+    which load_sitemap() reads back."""
+
+    def __init__(self, group: str, writer: IO = None):
+        self.group = group
+        self.authors = []
+        self._authors = {}
+        self._books = {}
+        self.writer = writer
+        if writer is not None:
+            self._write({"group": group})
+
+    def add(self, auth_uri: str, author: str, book_uri: str, book: str, file_info: Dict):
+        site_auth = self._authors.get(auth_uri)
+        if site_auth is None:
+            site_auth = {
+                "id": auth_uri,
+                "name": author,
+                "books": []
+            }
+            self._authors[auth_uri] = site_auth
+            self.authors.append(site_auth)
+
+        site_book = self._books.get((auth_uri, book_uri))
+        if site_book is None:
+            site_book = {
+                "title": book,
+                "id": book_uri,
+                "files": []
+            }
+            self._books[(auth_uri, book_uri)] = site_book
+            site_auth["books"].append(site_book)
+        site_book["files"].append(file_info)
+
+        if self.writer is not None:
+            self._write({"auth_uri": auth_uri, "author": author, "book_uri": book_uri, "book": book,
+                         "file_info": file_info})
+
+    def _write(self, record: Dict):
+        self.writer.write(json.dumps(record, ensure_ascii=False) + "\n")
+        # Readers may follow the file while the corpus is being converted.
+        self.writer.flush()
+
+    def as_dict(self) -> Dict:
+        return {
+            "group": self.group,
+            "authors": self.authors
+        }
+
+
+def load_sitemap(path: str) -> Dict:
+    """Read a sitemap written by convert_corpus, as JSON lines (see Sitemap),
+    or saved as a single JSON object."""
+    with open(path, encoding="utf-8") as f:
+        if not path.endswith(".jsonl"):
+            return json.load(f)
+        sitemap = None
+        for line in f:
+            record = json.loads(line)
+            if sitemap is None:
+                sitemap = Sitemap(record["group"])
+            else:
+                sitemap.add(**record)
+    if sitemap is None:
+        raise Exception(f"Empty sitemap {path}")
+    return sitemap.as_dict()
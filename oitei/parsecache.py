@@ -0,0 +1,65 @@
+import os
+import logging
+import oimdp
+from oimdp.structures import Document
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+OIMDP_VERSION = getattr(oimdp, "__version__", "unknown")
+
+
+class ParseCache:
+    """ Parsed mARkdown documents kept on disk, keyed by a hash of the text and the oimdp version,
+        so that converting the same text again skips parsing.
+        Documents are stored pickled and compressed: only use a folder you trust.
+        The modules needed for that are imported when used, to keep "import oitei" fast. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        import hashlib
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{digest}-{OIMDP_VERSION}"
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}.pickle.z")
+
+    def load(self, key: str) -> Optional[Document]:
+        import zlib
+        import pickle
+        try:
+            with open(self.entry_path(key), "rb") as f:
+                return pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning(f"Ignoring unreadable parse cache entry {self.entry_path(key)}")
+            return None
+
+    def store(self, key: str, document: Document):
+        import zlib
+        import pickle
+        from oitei._atomic import write_atomic
+        entry_path = self.entry_path(key)
+        folder = os.path.dirname(entry_path)
+        os.makedirs(folder, exist_ok=True)
+        write_atomic(entry_path, zlib.compress(pickle.dumps(document, protocol=pickle.HIGHEST_PROTOCOL), 1))
+
+    def parse(self, text: str) -> Document:
+        """ oimdp.parse(text), from the cache when possible. """
+        key = self.key(text)
+        document = self.load(key)
+        if document is not None:
+            self.hits += 1
+            return document
+        self.misses += 1
+        document = oimdp.parse(text)
+        try:
+            self.store(key, document)
+        except OSError:
+            logger.warning(f"Could not write parse cache entry {self.entry_path(key)}")
+        return document
@@ -0,0 +1,94 @@
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterable
+
+from lxml import etree
+
+
+def _tree_size(el) -> int:
+    return sum(1 for _ in el.iter(tag=etree.Element))
+
+
+class Profile:
+    """ Wall and CPU time spent in each phase of a conversion, with counts of the structures
+        and line parts converted, of the elements created and of the largest tree held in memory.
+        The time of a phase excludes the phases nested in it, so that the phases add up. """
+
+    def __init__(self):
+        self.phases = {}
+        self.structures = Counter()
+        self.parts = Counter()
+        self.elements = 0
+        self.peak_elements = 0
+        self._nested = []
+        self._template = None
+        self._released = 0
+
+    @contextmanager
+    def phase(self, name: str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        self._nested.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            inner_wall, inner_cpu = self._nested.pop()
+            totals = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            totals["wall"] += wall - inner_wall
+            totals["cpu"] += cpu - inner_cpu
+            if self._nested:
+                self._nested[-1][0] += wall
+                self._nested[-1][1] += cpu
+
+    def counting(self, convert, counter: Counter):
+        """ Wrap a convert(content, pos) method so that it counts the types it is given. """
+        def counted(content, pos):
+            counter[type(content).__name__] += 1
+            convert(content, pos)
+        return counted
+
+    def measure(self, doc):
+        """ Record the size of the tree. The first measure is taken of the empty template. """
+        size = _tree_size(doc)
+        if self._template is None:
+            self._template = size
+        self.peak_elements = max(self.peak_elements, size)
+        self.elements = size + self._released - self._template
+
+    def release(self, el):
+        """ Record that el and its descendants were written out and removed from the tree. """
+        self._released += _tree_size(el)
+
+    def as_dict(self) -> Dict:
+        return {
+            "phases": {name: dict(times) for name, times in self.phases.items()},
+            "structures": dict(self.structures),
+            "parts": dict(self.parts),
+            "elements": self.elements,
+            "peak_elements": self.peak_elements,
+        }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+def aggregate(profiles: Iterable[Dict]) -> Dict:
+    """ Add up profiles (as returned by Profile.as_dict()): times and counts are summed,
+        the peak tree size is the largest one. """
+    total = {"files": 0, "phases": {}, "structures": Counter(), "parts": Counter(), "elements": 0, "peak_elements": 0}
+    for profile in profiles:
+        total["files"] += 1
+        for name, times in profile["phases"].items():
+            totals = total["phases"].setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            totals["wall"] += times["wall"]
+            totals["cpu"] += times["cpu"]
+        total["structures"].update(profile["structures"])
+        total["parts"].update(profile["parts"])
+        total["elements"] += profile["elements"]
+        total["peak_elements"] = max(total["peak_elements"], profile["peak_elements"])
+    total["structures"] = dict(total["structures"])
+    total["parts"] = dict(total["parts"])
+    return total
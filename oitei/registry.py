@@ -0,0 +1,45 @@
+from typing import Callable, Dict, Optional
+
+
+class HandlerRegistry:
+    """Maps oimdp structure classes to the functions that convert them.
+    Look-ups are by exact type; subclasses of a registered class fall back to the
+    handler of their closest registered base class, as isinstance() would."""
+    def __init__(self, handlers: Dict[type, Callable] = None):
+        self._handlers = dict(handlers or {})
+        self._resolved = {}
+
+    def register(self, cls: type, handler: Callable = None):
+        """Register handler(converter, content, pos) for cls and its subclasses.
+        Can be used as a decorator when handler is omitted."""
+        if handler is None:
+            return lambda fn: self.register(cls, fn)
+        self._handlers[cls] = handler
+        self._resolved.clear()
+        return handler
+
+    def unregister(self, cls: type):
+        self._handlers.pop(cls, None)
+        self._resolved.clear()
+
+    def get(self, cls: type) -> Optional[Callable]:
+        try:
+            return self._resolved[cls]
+        except KeyError:
+            handler = None
+            for base in cls.__mro__:
+                if base in self._handlers:
+                    handler = self._handlers[base]
+                    break
+            self._resolved[cls] = handler
+            return handler
+
+    def values(self):
+        """The registered handlers."""
+        return self._handlers.values()
+
+    def copy(self):
+        return HandlerRegistry(self._handlers)
+
+    def __contains__(self, cls: type):
+        return self.get(cls) is not None
@@ -0,0 +1,246 @@
+import os
+import logging
+from typing import Dict, Iterable, Optional, Union
+
+from oitei._atomic import write_atomic
+from oitei.parsecache import OIMDP_VERSION
+
+logger = logging.getLogger(__name__)
+
+# When the cache grows over its size cap, the least recently used entries are removed until
+# it is this far below: the cache is not scanned again at every store.
+EVICT_TO = 0.9
+# Other processes may be filling the cache too: it is scanned again once this process has stored
+# this part of the size cap since the last scan. The cap can be overshot by that much per process.
+RESCAN = 0.1
+ENTRY_SUFFIX = ".xml.gz"
+
+# One instance per folder in each process, shared by the jobs a worker process receives:
+# see ResultCache.__reduce__().
+_open_caches: Dict[str, "ResultCache"] = {}
+
+
+def _open(path: str, max_size: Optional[int]) -> "ResultCache":
+    cache = _open_caches.get(path)
+    if cache is None or cache.max_size != max_size:
+        cache = _open_caches[path] = ResultCache(path, max_size)
+    return cache
+
+
+class ResultCache:
+    """ Serialized TEI documents kept on disk, keyed by a hash of the normalized text, its metadata,
+        the version record, the output options and the oitei and oimdp versions, so that converting
+        the same text again only copies out the result.
+        Entries are compressed. With a max_size (in bytes), the least recently used entries are
+        removed once the cache gets larger (see RESCAN). Several processes can use the same folder at once:
+        entries are written to a temporary file first, and an entry removed by another process
+        is a miss. hits, misses and evictions count what this process did (see stats()).
+        The modules needed are imported when used, to keep "import oitei" fast. """
+
+    def __init__(self, path: str, max_size: int = None):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Estimated size of the folder, from the last scan and the entries stored since.
+        self._size = None
+        self._stored = 0
+
+    def __reduce__(self):
+        return (_open, (self.path, self.max_size))
+
+    def key(self, text: Union[str, Iterable[str]], metadata: Dict = None, version_record: Dict = None,
+            pretty=True) -> str:
+        """ text is a string, or the consecutive chunks of one (see Converter.from_file).
+            A byte order mark and Windows line breaks do not change the key.
+            version_record is the version metadata, or any JSON data the output depends on besides
+            the text and metadata. """
+        import json
+        import hashlib
+        from oitei import __version__
+        context = [__version__, OIMDP_VERSION, pretty, metadata, version_record]
+        digest = hashlib.sha256(json.dumps(context, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        digest.update(b"\0")
+        if isinstance(text, str):
+            text = [text]
+        first = True
+        for chunk in text:
+            if first and chunk.startswith("\ufeff"):
+                chunk = chunk[1:]
+            first = False
+            digest.update(chunk.replace("\r\n", "\n").encode("utf-8"))
+        return digest.hexdigest()
+
+    def file_key(self, path: str, metadata: Dict = None, version_record: Dict = None, pretty=True) -> str:
+        """ The key of the mARkdown file at path, read in chunks. """
+        from oitei.converter import _read_chunks
+        return self.key(_read_chunks(path), metadata, version_record, pretty)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}{ENTRY_SUFFIX}")
+
+    def load(self, key: str) -> Optional[bytes]:
+        """ The TEI stored under key, or None. """
+        import gzip
+        entry_path = self.entry_path(key)
+        try:
+            with gzip.open(entry_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            logger.warning(f"Ignoring unreadable result cache entry {entry_path}")
+            self.misses += 1
+            return None
+        self._used(entry_path)
+        return data
+
+    def copy_to(self, key: str, dest: str) -> bool:
+        """ Write the TEI stored under key to the file dest, without holding it in memory.
+            Returns False, and leaves dest alone, when there is no such entry. """
+        import gzip
+        import shutil
+        entry_path = self.entry_path(key)
+        try:
+            source = gzip.open(entry_path, "rb")
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        try:
+            # Check the header before dest gets written to.
+            source.peek(1)
+        except Exception:
+            source.close()
+            logger.warning(f"Ignoring unreadable result cache entry {entry_path}")
+            self.misses += 1
+            return False
+        try:
+            with source:
+                write_atomic(dest, lambda f: shutil.copyfileobj(source, f))
+        except Exception:
+            logger.warning(f"Ignoring unreadable result cache entry {entry_path}")
+            self.misses += 1
+            return False
+        self._used(entry_path)
+        return True
+
+    def _used(self, entry_path: str):
+        self.hits += 1
+        # Entries are evicted by modification time: access times are often not kept up to date.
+        try:
+            os.utime(entry_path)
+        except OSError:
+            # Evicted by another process meanwhile.
+            pass
+
+    def store(self, key: str, data: bytes):
+        """ Store the TEI document data under key. """
+        self._store(key, lambda f: f.write(data))
+
+    def store_file(self, key: str, src: str):
+        """ Store the TEI document in the file src under key, without holding it in memory. """
+        import shutil
+        def copy(f):
+            with open(src, "rb") as source:
+                shutil.copyfileobj(source, f)
+        self._store(key, copy)
+
+    def _store(self, key: str, write):
+        import gzip
+        entry_path = self.entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        def compress(f):
+            with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=1, mtime=0) as z:
+                write(z)
+        size = write_atomic(entry_path, compress)
+        if self.max_size is not None and size > self.max_size:
+            # It would only push everything else out.
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            return
+        if self.max_size is not None:
+            self._stored += size
+            if self._size is None or self._stored >= self.max_size * RESCAN:
+                self._size = sum(size for _, size, _ in self._entries())
+                self._stored = 0
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self.evict(int(self.max_size * EVICT_TO))
+
+    def _entries(self): # -> list[tuple[int, int, str]]: (needs >python3.9)
+        """ (modification time, size, path) of every entry. """
+        entries = []
+        try:
+            with os.scandir(self.path) as it:
+                folders = [e.path for e in it if e.is_dir()]
+        except FileNotFoundError:
+            return entries
+        for folder in folders:
+            try:
+                with os.scandir(folder) as it:
+                    for e in it:
+                        if e.name.endswith(ENTRY_SUFFIX):
+                            try:
+                                st = e.stat()
+                            except FileNotFoundError:
+                                continue
+                            entries.append((st.st_mtime_ns, st.st_size, e.path))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict(self, max_size: int):
+        """ Remove the least recently used entries until the cache takes at most max_size bytes. """
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, entry_path in entries:
+            if size <= max_size:
+                break
+            try:
+                os.remove(entry_path)
+                self.evictions += 1
+            except FileNotFoundError:
+                # Evicted by another process.
+                pass
+            except OSError:
+                # In use by another process, on systems that do not allow removing open files.
+                continue
+            size -= entry_size
+        self._size = size
+        self._stored = 0
+
+    def stats(self) -> Dict:
+        """ Hits, misses and evictions in this process, with the number of entries and the size
+            of the cache on disk. """
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "size": sum(size for _, size, _ in entries),
+        }
+
+    def convert(self, text: str, metadata: Dict = None, pretty=True, jobs=1) -> bytes:
+        """ oitei.convert(text, metadata, jobs=jobs).tobytes(pretty), from the cache when possible. """
+        from oitei.converter import Converter
+        key = self.key(text, metadata, pretty=pretty)
+        data = self.load(key)
+        if data is not None:
+            return data
+        if text.startswith("\ufeff"):
+            text = text[1:]
+        C = Converter(text, metadata)
+        C.convert(jobs)
+        data = C.tobytes(pretty)
+        try:
+            self.store(key, data)
+        except OSError:
+            logger.warning(f"Could not write result cache entry {self.entry_path(key)}")
+        return data
@@ -0,0 +1,167 @@
+""" A long-lived conversion worker, for services that convert many books one at a time.
+    Starting Python and importing oitei for each book can take longer than converting it.
+
+    python -m oitei serve --jobs 4
+
+Reads one job per line of stdin, as JSON:
+
+    {"id": 1, "path": "0001Fulan.Kitab.Shamela0000001-ara1", "output": "tei.xml"}
+    {"id": 2, "text": "######OpenITI#...", "metadata": {"idno": ..., "book": ...}, "pretty": false}
+
+"path" is a mARkdown file and "text" is mARkdown given inline. "metadata" has the fields of
+oitei.Metadata. With "output", the TEI is written to that file. Without it, the TEI is returned
+in the result. "id" is sent back as is, so that results can be matched to their jobs.
+
+Writes one result per line of stdout, once its job is done. Results of jobs run in parallel may
+come back in any order:
+
+    {"id": 1, "ok": true, "output": "tei.xml", "bytes": 5196, "timings": {"read": ..., "total": ...}}
+    {"id": 3, "ok": false, "error": "FileNotFoundError: ...", "timings": {...}}
+
+Timings are in seconds: reading the file, parsing it, converting it and writing out the TEI.
+Before the first result, a {"ready": true, ...} line says that the worker is warmed up.
+The worker stops at the end of stdin, once all jobs are done. Logs go to stderr. """
+import sys
+import json
+import time
+import logging
+import threading
+import traceback
+from typing import Dict, IO
+
+from ._atomic import write_atomic
+from .converter import Converter
+
+logger = logging.getLogger(__name__)
+
+# Converted by each worker when it starts, so that the first job does not pay for warming up
+# oimdp and lxml.
+WARMUP_TEXT = "######OpenITI#\n\n#META#Header#End#\n# PageV01P001\n### | Warm up\n# text @YD100 text\n"
+
+
+def warm_up():
+    Converter(WARMUP_TEXT, None).convert()
+
+
+def run_job(job: Dict) -> Dict:
+    """ Convert a job. Errors are reported in the result rather than raised. """
+    result = {"id": job.get("id")}
+    timings = {}
+    start = lap = time.perf_counter()
+
+    def timed(phase):
+        nonlocal lap
+        now = time.perf_counter()
+        timings[phase] = now - lap
+        lap = now
+
+    try:
+        if "text" in job:
+            text = job["text"]
+        elif "path" in job:
+            with open(job["path"], "r") as f:
+                text = f.read()
+        else:
+            raise ValueError("Job has neither a path nor a text")
+        timed("read")
+
+        C = Converter(text, job.get("metadata"))
+        timed("parse")
+        C.convert()
+        timed("convert")
+
+        pretty = job.get("pretty", True)
+        output = job.get("output")
+        if output:
+            result["bytes"] = write_atomic(output, lambda f: C.write(f, pretty))
+            result["output"] = output
+        else:
+            result["tei"] = C.tostring(pretty)
+        timed("write")
+        result["ok"] = True
+    except Exception as e:
+        logger.error(f"Could not convert job {result['id']}")
+        logger.error(traceback.format_exc())
+        result["ok"] = False
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    timings["total"] = time.perf_counter() - start
+    result["timings"] = timings
+    return result
+
+
+def _failed(job_id, error: str) -> Dict:
+    return {"id": job_id, "ok": False, "error": error}
+
+
+def serve(input: IO[str], output: IO[str], jobs=1, in_flight: int = None):
+    """ Convert the jobs read from input, writing their results to output (see above).
+        With jobs > 1, jobs are converted by that many worker processes, and up to in_flight
+        jobs (by default twice as many) are handed out at once, so that workers do not wait
+        for the next job to be read. A single process converts one job at a time: in_flight
+        cannot be given with jobs=1. """
+    from oitei import __version__
+    if in_flight is not None and jobs <= 1:
+        raise ValueError("in_flight needs jobs > 1: a single process converts one job at a time")
+    lock = threading.Lock()
+
+    def emit(result: Dict):
+        with lock:
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=jobs, initializer=warm_up)
+        in_flight = in_flight or jobs * 2
+    else:
+        pool = None
+        in_flight = 1
+        warm_up()
+    emit({"ready": True, "oitei": __version__, "jobs": jobs, "in_flight": in_flight})
+
+    slots = threading.BoundedSemaphore(in_flight)
+
+    def done(future, job_id):
+        try:
+            result = future.result()
+        except Exception as e:
+            # The worker died (e.g. out of memory): the pool cannot take more jobs.
+            result = _failed(job_id, f"{type(e).__name__}: {e}")
+        emit(result)
+        slots.release()
+
+    try:
+        for line in input:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("Job is not a JSON object")
+            except ValueError as e:
+                emit(_failed(None, f"Invalid job: {e}"))
+                continue
+
+            if pool is None:
+                emit(run_job(job))
+                continue
+            slots.acquire()
+            try:
+                future = pool.submit(run_job, job)
+            except Exception as e:
+                slots.release()
+                emit(_failed(job.get("id"), f"{type(e).__name__}: {e}"))
+                continue
+            future.add_done_callback(lambda f, job_id=job.get("id"): done(f, job_id))
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+
+def main(args):
+    # Only results go to stdout: anything else printed during a conversion goes to stderr.
+    output = sys.stdout
+    sys.stdout = sys.stderr
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    serve(sys.stdin, output, args.jobs, args.in_flight)
@@ -29,4 +29,6 @@ TEI_TEMPLATE = """<TEI xmlns="http://www.tei-c.org/ns/1.0" xmlns:xi="http://www.
 DECLS = """<?xml version='1.0' encoding='UTF-8'?>
 <?xml-model href="/home/rviglian/Projects/tei_openiti/tei_openiti.rng" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"?>
 <?xml-model href="https://raw.githubusercontent.com/OpenITI/tei_openiti/master/tei_openiti.rng" type="application/xml" schematypens="http://purl.oclc.org/dsdl/schematron"?>
-"""
\ No newline at end of file
+"""
+
+DECLS_BYTES = DECLS.encode("utf-8")
@@ -1,6 +1,9 @@
+import re
 from setuptools import setup
 
-version = "2.0.0"
+# Kept in oitei/__init__.py only, which cannot be imported before the dependencies are installed.
+with open("oitei/__init__.py") as f:
+    version = re.search(r"^__version__ = ['\"]([^'\"]+)['\"]", f.read(), re.M).group(1)
 
 with open("README.md") as f:
     long_description = f.read()
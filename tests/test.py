@@ -1,17 +1,140 @@
 import sys
 import os
+import io
+import json
+import random
+import shutil
+import tempfile
+import threading
+import tracemalloc
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
 import unittest
+from unittest import mock
+import oimdp
 import oitei
-from oitei.corpus import convert_corpus
+from oimdp.structures import Line, PageNumber, RouteFrom, RouteTowa
+from lxml import etree
+from oitei import converter
+from oitei.namespaces import NS, TEINS
+from oitei.corpus import convert_corpus, load_sitemap
+from oitei.corpus.sitemap import SITEMAP
+from oitei.corpus.manifest import load_manifest
+from oitei.corpus.makesite import makesite_local
+from oitei.corpus import pipeline
+from oitei.corpus.makeauthor import make_author_record, make_author_record_bytes, make_author_record_str
+from oitei.corpus.makeversion import make_version_record
+from oitei.corpus.fieldmap import FieldMapper
+from oitei.corpus.fileindex import CorpusIndex
+from oitei.serve import serve
+from oitei.__main__ import main as oitei_main
+from openiti.helper.yml import readYML
+from openiti.helper.funcs import get_all_text_files_in_folder
+from oitei.corpus import corpus as corpus_module
+from benchmarks.generate import generate
+from benchmarks import imports
+
+
+def read_tree(path):
+    """ Contents of all files under path, except logs """
+    files = {}
+    for root, dirs, filenames in os.walk(path):
+        for fn in filenames:
+            if not fn.endswith(".log"):
+                with open(os.path.join(root, fn), "rb") as f:
+                    files[os.path.relpath(os.path.join(root, fn), path)] = f.read()
+    return files
+
+
+# Nesting edge cases: skipped and closing levels, typed divs inside and between sections.
+STRUCTURES = """######OpenITI#
+
+#META#Header#End#
+# PageV01P001
+### ||| deep section first
+# text
+### $ a biography
+# name of the person
+~~ more @YD300 text
+### | back to the top
+### $DIC_NIS$ an entry
+# text of the entry
+### || a subsection
+### $DOX_POS$ a position
+# text of the position
+# %~% verse %~% verse
+### ||| deeper
+### |EDITOR|
+# an editorial note
+PageV01P002
+### || up one
+### @ an event
+### | top again
+# $RWY$ isnad @MATN@ matn @HUKM@ hukm
+### |||| four levels
+# last
+### || two headers
+### || at the same level
+# text
+PageV01P003
+"""
+
+
+def random_sections(seed: int, count=300) -> str:
+    """ A document of section headers at random levels, some followed by text or a typed div. """
+    rng = random.Random(seed)
+    lines = ["######OpenITI#", "", "#META#Header#End#"]
+    for i in range(count):
+        lines.append(f"### {'|' * rng.randint(1, 4)} section {i}")
+        r = rng.random()
+        if r < 0.4:
+            lines.append(f"# text {i}")
+        elif r < 0.5:
+            lines.append(f"### $ biography {i}\n# name")
+    return "\n".join(lines) + "\n"
+
+
+class XPathConverter(oitei.Converter):
+    """ Locates containers by querying the tree, as the converter used to. """
+
+    def _closest_section(self):
+        closest = self.context_node.xpath("ancestor::tei:div[not(@type)]", namespaces=NS)
+        if len(closest):
+            return closest[-1]
+
+    def _closest_div(self):
+        closest = self.context_node.xpath("ancestor::tei:div", namespaces=NS)
+        if len(closest):
+            return closest[-1]
+
+    def _section_level(self):
+        return len(self.context_node.xpath("ancestor-or-self::tei:div[not(@type)]", namespaces=NS))
+
+    def _section_ancestor(self, level_diff):
+        ancestors = self.context_node.xpath("ancestor::tei:div[not(@type)]", namespaces=NS)
+        if len(ancestors):
+            return ancestors[level_diff]
 
 
 class TestStringMethods(unittest.TestCase):
 
+    corpus = os.path.join(os.path.dirname(__file__), "corpus", "data")
+
     def __init__(self, *args, **kwargs):
         super(TestStringMethods, self).__init__(*args, **kwargs)
 
+    def tmpdir(self) -> str:
+        """ A temporary folder, removed once the test is over """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        return tmp.name
+
+    def copy_corpus(self) -> str:
+        """ A copy of the test corpus, for tests that change it """
+        src = os.path.join(self.tmpdir(), "data")
+        shutil.copytree(self.corpus, src)
+        return src
+
     def test_generic(self):
         root = os.path.dirname(__file__)
         filepath = os.path.join(
@@ -23,7 +146,470 @@ class TestStringMethods(unittest.TestCase):
         self.converted = oitei.convert(self.text).tostring()
         with open(os.path.join(root, "test.xml"), 'w') as writer:
             writer.write(self.converted)
-    
+
+    def test_pagenum_lookdown(self):
+        root = os.path.dirname(__file__)
+        with open(os.path.join(root, "test.md"), "r") as test_file:
+            C = oitei.Converter(test_file.read(), None)
+
+        def scan(pos):
+            for c in C.md.content[pos:]:
+                if isinstance(c, PageNumber):
+                    return c
+                if isinstance(c, Line):
+                    for lp in c.parts:
+                        if isinstance(lp, PageNumber):
+                            return lp
+
+        for pos in range(len(C.md.content) + 1):
+            self.assertIs(C._pagenum_lookdown(pos), scan(pos))
+
+    def test_context_stack(self):
+        root = os.path.dirname(__file__)
+        texts = [STRUCTURES]
+        for fn in ["test.md", "ernst_jogiyan_markdown"]:
+            with open(os.path.join(root, fn), "r") as test_file:
+                texts.append(test_file.read())
+        for dirpath, dirs, files in os.walk(os.path.join(root, "corpus")):
+            for fn in files:
+                if not fn.endswith(".yml"):
+                    with open(os.path.join(dirpath, fn), "r") as test_file:
+                        texts.append(test_file.read())
+        texts.extend(random_sections(seed) for seed in range(10))
+        texts.extend(generate("200KB", seed=seed) for seed in range(1, 5))
+
+        for text in texts:
+            C = XPathConverter(text, None)
+            C.convert()
+            self.assertEqual(oitei.convert(text).tostring(), C.tostring())
+
+    def test_append_text(self):
+        C = oitei.Converter(STRUCTURES, None)
+        p = etree.SubElement(C.body, f"{TEINS}p")
+        C._appendText(p, "a")
+        C._appendText(p, "b")
+        lb = etree.SubElement(p, f"{TEINS}lb")
+        C._appendText(p, "c")
+        C._appendText(lb, "")
+        C._appendText(p, "d")
+        C._flushText()
+        self.assertEqual(p.text, "ab")
+        self.assertEqual(lb.text, "")
+        self.assertEqual(lb.tail, "cd")
+
+    def test_register_part(self):
+        text = "######OpenITI#\n\n#META#Header#End#\n# #$#FROM Baghdad #$#TOWA Kufa\n"
+        C = oitei.Converter(text, None)
+        C.part_handlers = C.part_handlers.copy()
+
+        @C.part_handlers.register(RouteFrom)
+        def route_from(converter, part, pos):
+            converter.context_linepart = etree.SubElement(converter.context_node, f"{TEINS}placeName")
+            converter.context_linepart.set("type", "from")
+
+        C.convert()
+        self.assertIn('<placeName type="from">Baghdad</placeName>Kufa', C.tostring())
+        self.assertNotIn(RouteFrom, oitei.Converter.part_handlers)
+
+        # Text added so far is in the tree when a handler is called
+        C = oitei.Converter(text, None)
+        C.part_handlers = C.part_handlers.copy()
+        tails = []
+
+        @C.part_handlers.register(RouteTowa)
+        def route_towa(converter, part, pos):
+            last = converter.context_node[-1]
+            tails.append(last.tail)
+            last.tail = (last.tail or "") + " to "
+
+        C.convert()
+        self.assertEqual(tails, ["Baghdad"])
+        self.assertIn("<lb/>Baghdad to Kufa", C.tostring())
+
+    def test_write_to(self):
+        root = os.path.dirname(__file__)
+        with open(os.path.join(root, "test.md"), "r") as test_file:
+            text = test_file.read()
+        streamed = io.BytesIO()
+        oitei.Converter(text, None).write_to(streamed)
+        self.assertEqual(streamed.getvalue().decode("utf-8"), oitei.convert(text).tostring())
+
+        # Ending inside a riwāyah
+        text = "######OpenITI#\n\n#META#Header#End#\n### | one\n# a\n### | two\n# $RWY$ isnad @MATN@ matn\n"
+        streamed = io.BytesIO()
+        oitei.Converter(text, None).write_to(streamed)
+        self.assertEqual(streamed.getvalue().decode("utf-8"), oitei.convert(text).tostring())
+
+        # A failed conversion leaves the previous file in place, and no temporary file
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, "out.xml")
+            oitei.Converter(text, None).write_to(dest)
+            with open(dest, "rb") as f:
+                previous = f.read()
+            C = oitei.Converter(text, None)
+            with mock.patch.object(C, "_serialize_child", side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    C.write_to(dest)
+            self.assertEqual(os.listdir(tmp), ["out.xml"])
+            with open(dest, "rb") as f:
+                self.assertEqual(f.read(), previous)
+
+    def test_low_memory(self):
+        root = os.path.dirname(__file__)
+        with open(os.path.join(root, "test.md"), "r") as test_file:
+            text = test_file.read()
+        for t in [STRUCTURES, text]:
+            expected = oitei.convert(t).tobytes()
+            C = oitei.convert(t, low_memory=True)
+            self.assertEqual(C.tobytes(), expected)
+            self.assertEqual(C.md.content, [])
+            streamed = io.BytesIO()
+            oitei.Converter(t, None, low_memory=True).write_to(streamed)
+            self.assertEqual(streamed.getvalue(), expected)
+
+        # Memory held by Python objects while converting and serializing, once parsed.
+        text = generate("100KB", seed=3)
+        usage = {}
+        for low_memory in [False, True]:
+            tracemalloc.start()
+            try:
+                C = oitei.Converter(text, None, low_memory=low_memory)
+                parsed = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                C.convert()
+                data = C.tobytes()
+                usage[low_memory] = (parsed,) + tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            del C, data
+        parsed, current, peak = usage[True]
+        # The parsed structures are released, and the output does not add up with them.
+        self.assertLess(current, parsed / 2)
+        self.assertLessEqual(peak, parsed * 1.05)
+        self.assertLess(peak, usage[False][2] * 0.9)
+
+    def test_from_file(self):
+        root = os.path.dirname(__file__)
+        with open(os.path.join(root, "test.md"), "r") as test_file:
+            test_md = test_file.read()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "book.md")
+            for text, chunk_sizes in [(STRUCTURES, [1, 200]), (test_md, [2000])]:
+                with open(path, "w") as f:
+                    f.write(text)
+                expected = oitei.convert(text).tobytes()
+                for chunk_size in chunk_sizes:
+                    chunks = list(converter._read_chunks(path, chunk_size))
+                    self.assertGreater(len(chunks), 1)
+                    self.assertEqual("".join(chunks), text)
+                    # Chunks end before a section header, unless they get too long.
+                    for previous, chunk in zip(chunks, chunks[1:]):
+                        self.assertTrue(chunk.startswith("### |") or len(previous) >= 4 * chunk_size)
+                    streamed = io.BytesIO()
+                    oitei.Converter.from_file(path, None, chunk_size=chunk_size).write_to(streamed)
+                    self.assertEqual(streamed.getvalue(), expected)
+                    C = oitei.Converter.from_file(path, None, chunk_size=chunk_size)
+                    C.convert()
+                    self.assertEqual(C.tobytes(), expected)
+
+            # A leading byte order mark is skipped
+            with open(path, "w") as f:
+                f.write("﻿" + STRUCTURES)
+            C = oitei.Converter.from_file(path, None)
+            C.convert()
+            self.assertEqual(C.tobytes(), oitei.convert(STRUCTURES).tobytes())
+
+            # Neither the whole text nor the whole parsed document is held in memory.
+            with open(path, "w") as f:
+                f.write(generate("100KB", seed=3))
+            peaks = []
+            for chunked in [False, True]:
+                tracemalloc.start()
+                try:
+                    if chunked:
+                        C = oitei.Converter.from_file(path, None, chunk_size=10000)
+                    else:
+                        with open(path, "r") as f:
+                            C = oitei.Converter(f.read(), None)
+                    C.write_to(os.path.join(tmp, "book.xml"))
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                finally:
+                    tracemalloc.stop()
+                del C
+            self.assertLess(peaks[1], peaks[0] * 0.75)
+
+    def test_tobytes(self):
+        C = oitei.convert(STRUCTURES)
+        for pretty in [True, False]:
+            data = C.tobytes(pretty)
+            self.assertEqual(data, C.tostring(pretty).encode("utf-8"))
+            written = io.BytesIO()
+            C.write(written, pretty)
+            self.assertEqual(written.getvalue(), data)
+
+        # Pretty output leaves the tree alone: compact output does not depend on the order of calls
+        compact = oitei.convert(STRUCTURES).tobytes(False)
+        pretty = C.tobytes()
+        self.assertEqual(C.tobytes(False), compact)
+        C.write(io.BytesIO())
+        self.assertEqual(C.tobytes(False), compact)
+        self.assertEqual(C.tobytes(), pretty)
+
+        yml = readYML(os.path.join(os.path.dirname(__file__), "corpus", "data", "0001Fulan", "0001Fulan.yml"))
+        self.assertEqual(make_author_record_bytes(yml), make_author_record_str(yml).encode("utf-8"))
+
+    def test_field_mapper(self):
+        seen = []
+        mapper = FieldMapper([("10#AUTH#", lambda rec, fields, value, entry: rec.append((fields, value))),
+                              ("00#", lambda rec, fields, value, entry: seen.append(entry))])
+        yml = {"00#AUTH#URI######:": "0001Fulan", "10#AUTH#ISM####AR:": "Fulān", "99#AUTH#OTHER####:": "x"}
+        self.assertEqual(mapper.apply(yml, []), [(["10", "AUTH", "ISM", "AR:"], "Fulān")])
+        self.assertEqual(seen, ["00#AUTH#URI######:"])
+        # Keys are matched once, including those without a rule.
+        self.assertEqual(len(mapper._keys), 3)
+        self.assertIs(mapper.lookup("10#AUTH#ISM####AR:"), mapper.lookup("10#AUTH#ISM####AR:"))
+        self.assertIsNone(mapper.lookup("99#AUTH#OTHER####:"))
+
+        data = os.path.join(os.path.dirname(__file__), "corpus", "data", "0001Fulan")
+        record = make_author_record(readYML(os.path.join(data, "0001Fulan.yml")))
+        person = record.find("person")
+        self.assertEqual(person.get("{http://www.w3.org/XML/1998/namespace}id"), "oitei_0001Fulan")
+        self.assertEqual(len(person.findall("persName")), 1)
+        self.assertEqual(len(person.findall("persName/name")), 6)
+        self.assertEqual(len(person.findall("birth")), 1)
+        self.assertEqual(person.find("birth").get("when-custom"), "YEAR-MON-DA (X+ for unknown)")
+        self.assertEqual(len(person.findall("death/placeName")), 2)
+        self.assertEqual([r.get("name") for r in record.findall("listRelation/relation")],
+                         ["students", "students", "teachers", "teachers"])
+
+        version = make_version_record(readYML(os.path.join(
+            data, "0001Fulan.Kitab", "0001Fulan.Kitab.Shamela0000001-ara1.yml")))
+        self.assertEqual(version["uri"], "oitei_0001Fulan.Kitab.Shamela0000001-ara1")
+        self.assertEqual([m.get("unit") for m in version["extent"]], ["words", "characters"])
+        self.assertEqual(version["date"][0].get("when"), "YYYY-MM-DD")
+
+    def test_write_shards(self):
+        expected = oitei.convert(STRUCTURES).doc
+        with tempfile.TemporaryDirectory() as tmp:
+            master = os.path.join(tmp, "book.xml")
+            shards = oitei.Converter(STRUCTURES, None).write_shards(master, 600)
+            self.assertGreater(len(shards), 1)
+            for shard in shards:
+                # Only a single division can make a shard go over the limit
+                if os.path.getsize(shard) > 600:
+                    self.assertEqual(len(etree.parse(shard).getroot()), 1)
+
+            tree = etree.parse(master)
+            self.assertEqual(len(tree.xpath("//xi:include", namespaces=NS)), len(shards))
+            tree.xinclude()
+            self.assertEqual(
+                [(el.tag, (el.text or "").strip()) for el in tree.iter()],
+                [(el.tag, (el.text or "").strip()) for el in expected.iter()])
+
+    def test_convert_parallel(self):
+        root = os.path.dirname(__file__)
+        with open(os.path.join(root, "test.md"), "r") as test_file:
+            test_md = test_file.read()
+        with mock.patch.object(converter, "MIN_CHUNK", 5):
+            for text in [STRUCTURES * 10, generate("50KB", seed=3), test_md]:
+                sequential = oitei.convert(text)
+                C = oitei.Converter(text, None)
+                self.assertGreater(len(C._chunks(2)), 1)
+                C.convert(jobs=2)
+                self.assertEqual(C.tostring(), sequential.tostring())
+                self.assertIs(C.context_linepart is None, sequential.context_linepart is None)
+
+            # A chunk that does not start as predicted is converted again in one process.
+            text = STRUCTURES * 10
+            C = oitei.Converter(text, None)
+            chunks = [(start, end, not open_seg) for start, end, open_seg in C._chunks(2)]
+            with mock.patch.object(oitei.Converter, "_chunks", return_value=chunks):
+                with self.assertLogs("oitei.converter", "INFO"):
+                    C.convert(jobs=2)
+            self.assertEqual(C.tostring(), oitei.convert(text).tostring())
+
+        # Small documents are not split.
+        self.assertEqual(oitei.Converter(STRUCTURES, None)._chunks(2), [])
+
+    def test_indent(self):
+        # Deeper than the recursion limit
+        tree = etree.Element("div")
+        el = tree
+        for i in range(sys.getrecursionlimit() + 100):
+            el = etree.SubElement(el, "div")
+            el.tail = "text\n"
+        converter._indent(tree)
+        self.assertEqual(el.getparent().text, "\n" + converter.SPACE * len(list(el.iterancestors())))
+        self.assertEqual(el.tail, "text\n" + converter.SPACE * (len(list(el.iterancestors())) - 1))
+
+        # Compact output has no indentation, streamed or not
+        root = os.path.dirname(__file__)
+        with open(os.path.join(root, "test.md"), "r") as test_file:
+            text = test_file.read()
+        compact = oitei.convert(text).tostring(pretty=False)
+        streamed = io.BytesIO()
+        oitei.Converter(text, None).write_to(streamed, pretty=False)
+        self.assertEqual(streamed.getvalue().decode("utf-8"), compact)
+        self.assertNotIn("<body>\n", compact)
+        self.assertLess(len(compact), len(oitei.convert(text).tostring()))
+
+    def test_profile(self):
+        self.assertIsNone(oitei.convert(STRUCTURES).profile)
+
+        C = oitei.convert(STRUCTURES, profile=True)
+        C.tostring()
+        profile = C.profile.as_dict()
+        for phase in ["parse", "index", "header", "convert", "indent", "serialize"]:
+            self.assertIn(phase, profile["phases"])
+        self.assertEqual(profile["structures"]["SectionHeader"], 9)
+        self.assertEqual(profile["parts"]["Matn"], 1)
+        self.assertEqual(profile["elements"], len(C.doc.xpath("//*")) - len(etree.fromstring(converter.TEI_TEMPLATE).xpath("//*")))
+
+        # Streaming creates as many elements, but holds fewer at once
+        streamed = oitei.Converter(STRUCTURES, None, profile=True)
+        streamed.write_to(io.BytesIO())
+        self.assertEqual(streamed.profile.elements, profile["elements"])
+        self.assertLess(streamed.profile.peak_elements, profile["peak_elements"])
+
+        tmp = self.tmpdir()
+        convert_corpus(self.corpus, tmp, profile=True)
+        with open(os.path.join(tmp, corpus_module.PROFILE)) as f:
+            report = json.load(f)
+        self.assertEqual(report["total"]["files"], 3)
+        self.assertEqual(len(report["files"]), 3)
+
+    def test_parse_cache(self):
+        root = os.path.dirname(__file__)
+        with open(os.path.join(root, "test.md"), "r") as test_file:
+            text = test_file.read()
+        expected = oitei.convert(text).tostring()
+        self.assertEqual(oitei.convert_from_document(oimdp.parse(text)).tostring(), expected)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = oitei.ParseCache(tmp)
+            self.assertEqual(oitei.convert(text, parse_cache=cache).tostring(), expected)
+            with mock.patch("oimdp.parse") as parse:
+                self.assertEqual(oitei.convert(text, parse_cache=cache).tostring(), expected)
+                parse.assert_not_called()
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # A damaged entry is parsed again
+            with open(cache.entry_path(cache.key(text)), "wb") as f:
+                f.write(b"damaged")
+            self.assertEqual(oitei.convert(text, parse_cache=cache).tostring(), expected)
+            self.assertEqual(cache.misses, 2)
+
+    def test_result_cache(self):
+        expected = oitei.convert(STRUCTURES).tobytes()
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = oitei.ResultCache(tmp)
+            self.assertEqual(cache.convert(STRUCTURES), expected)
+            with mock.patch("oimdp.parse") as parse:
+                self.assertEqual(cache.convert(STRUCTURES), expected)
+                # Line breaks and a byte order mark do not count
+                self.assertEqual(cache.convert("﻿" + STRUCTURES.replace("\n", "\r\n")), expected)
+                parse.assert_not_called()
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+            self.assertEqual(cache.convert(STRUCTURES, pretty=False), oitei.convert(STRUCTURES).tobytes(False))
+            self.assertEqual(cache.misses, 2)
+            self.assertEqual(cache.key(STRUCTURES), cache.key(iter(STRUCTURES.splitlines(True))))
+            self.assertNotEqual(cache.key(STRUCTURES), cache.key(STRUCTURES, {"idno": "x"}))
+
+            # A damaged entry is converted again
+            with open(cache.entry_path(cache.key(STRUCTURES)), "wb") as f:
+                f.write(b"damaged")
+            self.assertEqual(cache.convert(STRUCTURES), expected)
+            self.assertFalse(cache.copy_to("missing", os.path.join(tmp, "out.xml")))
+            self.assertFalse(os.path.exists(os.path.join(tmp, "out.xml")))
+
+        # The least recently used entries go first
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = oitei.ResultCache(tmp, max_size=3500)
+            keys = [cache.key(name) for name in "abcd"]
+            for i, key in enumerate(keys[:3]):
+                cache.store(key, os.urandom(1000))
+                os.utime(cache.entry_path(key), (i, i))
+            self.assertIsNotNone(cache.load(keys[0]))
+            cache.store(keys[3], os.urandom(1000))
+            self.assertEqual([os.path.exists(cache.entry_path(k)) for k in keys], [True, False, True, True])
+            stats = cache.stats()
+            self.assertEqual((stats["evictions"], stats["entries"]), (1, 3))
+            self.assertLessEqual(stats["size"], 3500)
+
+    def test_corpus_result_cache(self):
+        tmp = self.tmpdir()
+        cache = os.path.join(tmp, "cache")
+        serial = os.path.join(tmp, "serial")
+        sitemap = convert_corpus(self.corpus, serial)
+        for i, options in enumerate([{}, {"jobs": 2}, {"stream": True}]):
+            out = os.path.join(tmp, str(i))
+            with self.assertLogs("oitei.corpus.corpus", "INFO") as logs:
+                self.assertEqual(convert_corpus(self.corpus, out, result_cache=cache, **options), sitemap)
+            self.assertEqual(read_tree(out), read_tree(serial))
+            hits = "0 hits, 3 misses" if i == 0 else "3 hits, 0 misses"
+            self.assertTrue(any(hits in line for line in logs.output))
+
+    def test_serve(self):
+        path = os.path.join(self.corpus, "0001Fulan", "0001Fulan.Kitab", "0001Fulan.Kitab.Shamela0000001-ara1")
+        with open(path, "r") as f:
+            expected = oitei.convert(f.read()).tobytes()
+        metadata = {"prefix": "pre", "idno": "0001Fulan.Kitab.Shamela0000001-ara1", "auth_uri": "0001Fulan",
+                    "author": "Fulān", "book_uri": "0001Fulan.Kitab", "book": "Kitāb"}
+
+        tmp = self.tmpdir()
+        jobs = [
+            {"id": 1, "path": path, "output": os.path.join(tmp, "1.xml")},
+            {"id": 2, "text": STRUCTURES, "metadata": metadata, "pretty": False},
+            {"id": 3, "path": os.path.join(tmp, "missing")},
+            {"id": 4},
+        ]
+        lines = "\n".join(json.dumps(job) for job in jobs) + "\nnot json\n\n"
+        for workers in [1, 2]:
+            output = io.StringIO()
+            serve(io.StringIO(lines), output, jobs=workers)
+            results = [json.loads(line) for line in output.getvalue().splitlines()]
+            self.assertTrue(results[0]["ready"])
+            results = {r["id"]: r for r in results[1:]}
+            self.assertEqual(len(results), 5)
+
+            self.assertTrue(results[1]["ok"])
+            self.assertEqual(set(results[1]["timings"]), {"read", "parse", "convert", "write", "total"})
+            with open(os.path.join(tmp, "1.xml"), "rb") as f:
+                self.assertEqual(f.read(), expected)
+            self.assertEqual(results[1]["bytes"], len(expected))
+
+            C = oitei.convert(STRUCTURES, metadata)
+            self.assertEqual(results[2]["tei"], C.tostring(False))
+            self.assertTrue(results[3]["error"].startswith("FileNotFoundError"))
+            self.assertFalse(results[4]["ok"])
+            self.assertTrue(results[None]["error"].startswith("Invalid job"))
+
+        # A single process takes one job at a time
+        with self.assertRaises(ValueError):
+            serve(io.StringIO(lines), io.StringIO(), jobs=1, in_flight=4)
+        with mock.patch("sys.stderr", io.StringIO()) as stderr, self.assertRaises(SystemExit):
+            oitei_main(["serve", "--in-flight", "4"])
+        self.assertIn("--in-flight needs --jobs > 1", stderr.getvalue())
+
+    def test_benchmark_generator(self):
+        text = generate("50KB", seed=3)
+        self.assertEqual(text, generate("50KB", seed=3))
+        self.assertGreaterEqual(len(text.encode("utf-8")), 50 * 1024)
+        C = oitei.Converter(text, None)
+        kinds = set(type(c).__name__ for c in C.md.content)
+        for kind in ["SectionHeader", "Riwayat", "Verse", "PageNumber", "BioOrEvent", "Paragraph"]:
+            self.assertIn(kind, kinds)
+        C.convert()
+        tei = C.tostring()
+        self.assertIn("<persName", tei)
+        self.assertIn('<l>', tei)
+
+    def test_import_cost(self):
+        for module in imports.MODULES:
+            result = imports.bench_import(module, repeat=1)
+            self.assertEqual(result["deferred_loaded"], [])
+            self.assertEqual(result["log_handlers"], 0)
+
     # def test_corpus_single(self):
     #     root = os.path.dirname(__file__)
     #     filepath = os.path.join(
@@ -40,6 +626,186 @@ class TestStringMethods(unittest.TestCase):
     def test_corpus(self):
         convert_corpus("../OpenITI-Corpus/0575AH/data/0562Samcani/0562Samcani.Tahbir")
 
+    def test_corpus_parallel(self):
+        tmp = self.tmpdir()
+        serial = os.path.join(tmp, "serial")
+        parallel = os.path.join(tmp, "parallel")
+        sitemap = convert_corpus(self.corpus, serial)
+        self.assertEqual(convert_corpus(self.corpus, parallel, jobs=2), sitemap)
+        self.assertEqual(read_tree(parallel), read_tree(serial))
+        self.assertEqual(len(sitemap["authors"]), 2)
+
+    def test_corpus_sitemap(self):
+        tmp = self.tmpdir()
+        sitemap = convert_corpus(self.corpus, tmp)
+        self.assertEqual(load_sitemap(os.path.join(tmp, SITEMAP)), sitemap)
+        # Two authors and two books, for three versions
+        books = [book for auth in sitemap["authors"] for book in auth["books"]]
+        self.assertEqual(len(books), 2)
+        self.assertEqual(sum(len(book["files"]) for book in books), 3)
+
+        with open(os.path.join(tmp, "sitemap.json"), "w") as f:
+            json.dump(sitemap, f)
+        self.assertEqual(load_sitemap(os.path.join(tmp, "sitemap.json")), sitemap)
+
+    def test_makesite_local(self):
+        templates = {
+            "assets/tpl-cetei.html": "<title>{title}</title><script>function(){}</script>{tei_filename}",
+            "assets/tpl-toc-entry.html": "<li>{title} {filename}</li>",
+            "assets/tpl-toc-book.html": "<h3>{book}</h3><ul>{entries}</ul>",
+            "assets/tpl-toc-auth.html": "<h2>{auth}</h2>{books}",
+            "index.html": "<h1>{group}</h1>{toc}",
+        }
+        sitemap = {"group": "G", "authors": [{"id": "A", "name": "Author", "books": [
+            {"id": "A.B", "title": "Book", "files": [
+                {"filename": "A.B.V1", "title": "One", "version": "v1"},
+                {"filename": "A.B.V2", "title": "{book}", "version": "v2"}]}]}]}
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, text in templates.items():
+                os.makedirs(os.path.dirname(os.path.join(tmp, name)), exist_ok=True)
+                with open(os.path.join(tmp, name), "w") as f:
+                    f.write(text)
+            makesite_local(tmp, sitemap, repo="R", threads=2)
+            with open(os.path.join(tmp, "index.html")) as f:
+                self.assertEqual(f.read(), "<h1>G</h1><h2>Author</h2><h3>Book</h3><ul><li>One A.B.V1</li><li>{book} A.B.V2</li></ul>")
+            with open(os.path.join(tmp, "A.B.V2", "index.html")) as f:
+                self.assertEqual(f.read(), "<title>{book}</title><script>function(){}</script>R/G/tei/A/A.B/A.B.V2.xml")
+
+    def test_corpus_pipeline(self):
+        tmp = self.tmpdir()
+        serial = os.path.join(tmp, "serial")
+        pipelined = os.path.join(tmp, "pipelined")
+        sitemap = convert_corpus(self.corpus, serial)
+        self.assertEqual(convert_corpus(self.corpus, pipelined, pipeline=True), sitemap)
+        self.assertEqual(read_tree(pipelined), read_tree(serial))
+
+        # Files that could not be written are not recorded as converted
+        out = os.path.join(tmp, "failing")
+        write = pipeline._write_file
+        def failing(p, data):
+            if p.endswith("Shamela0000001-ara1.xml"):
+                raise OSError("disk full")
+            write(p, data)
+        with mock.patch.object(pipeline, "_write_file", failing):
+            convert_corpus(self.corpus, out, incremental=True, pipeline=True)
+        with open(os.path.join(out, "oitei-manifest.json")) as f:
+            manifest = json.load(f)
+        converted = {os.path.basename(k): entry["converted"] for k, entry in manifest["files"].items()}
+        self.assertEqual(converted, {
+            "0001Fulan.Kitab.JK000002-ara1.completed": True,
+            "0001Fulan.Kitab.Shamela0000001-ara1": False,
+            "0002Fulana.Risala.Shamela0000003-ara1.mARkdown": True})
+
+    def test_background_writer(self):
+        started = threading.Event()
+        release = threading.Event()
+        write = pipeline._write_file
+        def slow(p, data):
+            started.set()
+            release.wait()
+            write(p, data)
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(pipeline, "_write_file", slow):
+            writer = pipeline.BackgroundWriter(threads=1, max_pending=10)
+            writer.write(os.path.join(tmp, "a"), "123456")
+            started.wait()
+            # No room left for the next file until the first one is written
+            second = threading.Thread(target=writer.write, args=(os.path.join(tmp, "b"), "123456"))
+            second.start()
+            second.join(0.2)
+            self.assertTrue(second.is_alive())
+            self.assertEqual(writer.pending, 6)
+            release.set()
+            second.join()
+            self.assertEqual(writer.close(), set())
+            self.assertEqual(writer.pending, 0)
+            self.assertEqual(sorted(os.listdir(tmp)), ["a", "b"])
+
+        writer = pipeline.BackgroundWriter()
+        missing = os.path.join(tmp, "missing", "c")
+        with self.assertLogs("oitei.corpus.pipeline", "ERROR"):
+            writer.write(missing, b"data")
+            self.assertEqual(writer.close(), {missing})
+
+    def test_corpus_records_processed_once(self):
+        tmp = self.tmpdir()
+        with mock.patch.object(corpus_module, "process_metadata", wraps=corpus_module.process_metadata) as process:
+            convert_corpus(self.corpus, os.path.join(tmp, "tei"))
+        # Two authors and two books, for three versions
+        self.assertEqual(process.call_count, 4)
+
+    def test_corpus_index(self):
+        index = CorpusIndex(self.corpus)
+        self.assertEqual(index.texts, list(get_all_text_files_in_folder(self.corpus)))
+        for mdf in index.texts:
+            self.assertEqual(index.locate(mdf), corpus_module.locate_metadata(mdf))
+        self.assertEqual(index.missing(), {})
+
+        # The author metadata of a book folder is above it
+        book = os.path.join(self.corpus, "0001Fulan", "0001Fulan.Kitab")
+        index = CorpusIndex(book)
+        self.assertEqual(len(index.texts), 2)
+        for mdf in index.texts:
+            self.assertEqual(index.locate(mdf), corpus_module.locate_metadata(mdf))
+        tmp = self.tmpdir()
+        sitemap = convert_corpus(book, tmp)
+        self.assertEqual(len(sitemap["authors"][0]["books"][0]["files"]), 2)
+        self.assertEqual(len([fn for fn in read_tree(tmp) if fn.endswith(".xml")]), 4)
+
+        src = self.copy_corpus()
+        out = os.path.join(self.tmpdir(), "tei")
+        os.remove(os.path.join(src, "0002Fulana", "0002Fulana.yml"))
+        os.remove(os.path.join(src, "0001Fulan", "0001Fulan.Kitab", "0001Fulan.Kitab.Shamela0000001-ara1.yml"))
+        missing = {os.path.basename(mdf): kinds for mdf, kinds in CorpusIndex(src).missing().items()}
+        self.assertEqual(missing, {
+            "0001Fulan.Kitab.Shamela0000001-ara1": ["version"],
+            "0002Fulana.Risala.Shamela0000003-ara1.mARkdown": ["author"]})
+
+        # Reported before anything is converted; files without an author are skipped
+        with self.assertLogs("oitei.corpus.corpus", "INFO") as logs:
+            sitemap = convert_corpus(src, out)
+        self.assertEqual([r.levelname for r in logs.records[:2]], ["ERROR", "ERROR"])
+        self.assertEqual([a["id"] for a in sitemap["authors"]], ["0001Fulan"])
+        self.assertFalse(os.path.exists(os.path.join(out, "0002Fulana")))
+
+    def test_corpus_incremental(self):
+        src = self.copy_corpus()
+        out = os.path.join(self.tmpdir(), "tei")
+        sitemap = convert_corpus(src, out, incremental=True)
+
+        # Unchanged files are not converted again
+        tei = os.path.join(out, "0001Fulan", "0001Fulan.Kitab", "0001Fulan.Kitab.Shamela0000001-ara1.xml")
+        os.utime(tei, (0, 0))
+        self.assertEqual(convert_corpus(src, out, incremental=True), sitemap)
+        self.assertEqual(os.path.getmtime(tei), 0)
+
+        # Changing a YAML file converts the files that depend on it
+        with open(os.path.join(src, "0001Fulan", "0001Fulan.yml"), "a") as yml:
+            yml.write("\n")
+        convert_corpus(src, out, incremental=True)
+        self.assertNotEqual(os.path.getmtime(tei), 0)
+
+        # Changing the output options converts everything again, in the new layout
+        os.utime(tei, (0, 0))
+        sharded = convert_corpus(src, out, incremental=True, shard_size=1000)
+        self.assertEqual(sharded, sitemap)
+        self.assertNotEqual(os.path.getmtime(tei), 0)
+        with open(tei, encoding="utf-8") as f:
+            self.assertIn("xi:include", f.read())
+        shards = [o for entry in load_manifest(out)["files"].values() for o in entry["outputs"]
+                  if o.endswith(".001.xml")]
+        self.assertTrue(shards)
+        # and going back to single files removes the shards
+        convert_corpus(src, out, incremental=True)
+        for shard in shards:
+            self.assertFalse(os.path.exists(os.path.join(out, shard)))
+
+        # Outputs of removed sources are deleted
+        os.remove(os.path.join(src, "0002Fulana", "0002Fulana.Risala", "0002Fulana.Risala.Shamela0000003-ara1.mARkdown"))
+        sitemap = convert_corpus(src, out, incremental=True)
+        self.assertEqual(len(sitemap["authors"]), 1)
+        self.assertFalse(os.path.exists(os.path.join(out, "0002Fulana")))
+
     # def test_ernst(self):
     #     root = os.path.dirname(__file__)
     #     filepath = os.path.join(